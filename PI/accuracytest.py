@@ -1,85 +1,87 @@
-import sys
-import time
-from typing import Optional
-import evdev
-from evdev import ecodes
-import serial
+import argparse
+import numpy as np
+from step_board import BoardWatcher, MultiBoardReader
+from step_calibration import Calibration, DEFAULT_PATH, board_path
+from step_engine import AcquisitionEngine, CollectSink, SerialSink, StatsSink
 
-def get_board_device() -> Optional[evdev.InputDevice]:
-    """ Return the Wii Balance Board device. """
-    devices = [
-        path
-        for path in evdev.list_devices()
-        if evdev.InputDevice(path).name == "Nintendo Wii Remote Balance Board"
-    ]
-    if not devices:
-        return None
 
-    board = evdev.InputDevice(
-        devices[0],
-    )
-    return board
+def mean_measurement(sink: CollectSink, samples: int):
+    """Average the raw sensor values of the next `samples` measurements."""
+    # discard what was buffered while waiting for the user
+    sink.clear()
+    return np.mean([data for _, _, _, data in sink.take(samples)], axis=0)
 
 
-def get_raw_measurement(device: evdev.InputDevice):
-    """Read one measurement from the board."""
-    data = [None] * 4
-    length = 228
-    width = 433
+def encode_text(board, seq, timestamp, data) -> bytes:
+    return f"{str([round(i, 2) for i in data] + [round(timestamp, 6)])}\n".encode()
+
+
+def calibrate(sink: CollectSink, path: str, samples: int):
+    """
+    Fit the sensor gains from known weights. The board is tared first, then the user places known weights at
+    different positions on the board. After four or more measurements the gains are fitted with least squares and
+    the accuracy of every measurement is reported.
+    """
+    calibration = Calibration.load(path)
+    input("Remove everything from the board and press enter to tare...")
+    calibration.offsets = mean_measurement(sink, samples)
+    print(f"Offsets: {calibration.offsets.round(1).tolist()}")
+
+    raw = []
+    weights = []
     while True:
-        event = device.read_one()
-        if event is None:
+        answer = input("Place a known weight on the board and enter its weight in kg (empty to finish): ")
+        if not answer.strip():
+            if len(raw) >= 4:
+                break
+            print("At least four measurements are needed, use different positions on the board.")
+            continue
+        try:
+            weight = float(answer)
+        except ValueError:
+            print("Please enter a number.")
             continue
-        # Measurements are in decigrams, so we convert them to kilograms here.
-        if event.code == ecodes.ABS_HAT1X:
-            # Top left.
-            data[0] = event.value
-        elif event.code == ecodes.ABS_HAT0X:
-            # Top right.
-            data[1] = event.value
-        elif event.code == ecodes.ABS_HAT0Y:
-            # Bottom left.
-            data[2] = event.value
-        elif event.code == ecodes.ABS_HAT1Y:
-            # Bottom right.
-            data[3] = event.value
-        elif event.code == ecodes.BTN_A:
-            sys.exit("ERROR: User pressed board button while measuring, aborting.")
-        elif event.code == ecodes.SYN_DROPPED:
-            pass
-        elif event.code == ecodes.SYN_REPORT and event.value == 3:
-            pass
-        elif event.code == ecodes.SYN_REPORT and event.value == 0:
-            # TODO: optimise cpu usage when no event is received
-            if None in data:
-                # This measurement failed to read one of the sensors, try again.
-                data = [None] * 4
-                continue
-            else:
-                return data
-        else:
-            print(f"ERROR: Got unexpected event: {evdev.categorize(event)}")
+        raw.append(mean_measurement(sink, samples))
+        # board units are 1/100 kg
+        weights.append(weight * 100)
+
+    calibration.gains, residuals = Calibration.fit_gains(raw, weights, calibration.offsets)
+    print(f"Gains: {calibration.gains.round(4).tolist()}")
+    for weight, residual in zip(weights, residuals):
+        print(f"{weight / 100:.2f} kg: error {residual / 100:+.3f} kg ({100 * residual / weight:+.2f}%)")
+    calibration.save(path)
+    print(f"Calibration saved to {path}")
 
 
 if __name__ == "__main__":
-    boardfound = None
-    while not boardfound:
-        boardfound = get_board_device()
-        if boardfound:
-            print("\aBalance board found, please step on.")
-            break
-        time.sleep(0.5)
-    while True:
-        try:
-            print("Opening serial port...")
-            with serial.Serial('/dev/ttyGS0', 9600, timeout=1) as ser:
-                print(f"Serial port {ser.name} opened.")
-                while True:
-                    data = get_raw_measurement(boardfound)
-                    ser.reset_output_buffer()
-                    ser.write(f"{str(data)}\n".encode())
-                    time.sleep(0.01)
+    parser = argparse.ArgumentParser(description="Calibrate the balance board with known weights, or stream its "
+                                                 "calibrated sensor values.")
+    parser.add_argument('--stream', action='store_true', help="stream the sensor values instead of calibrating")
+    parser.add_argument('--calibration', default=DEFAULT_PATH, help="calibration file")
+    parser.add_argument('--board', type=int, default=0,
+                        help="index of the board when several are connected, every board has its own calibration file")
+    parser.add_argument('--samples', type=int, default=200, help="number of samples averaged per measurement")
+    parser.add_argument('--cpu-report', type=float, default=0, metavar='SECONDS',
+                        help="print the CPU usage per delivered sample every SECONDS seconds")
+    args = parser.parse_args()
 
-        except serial.SerialException as e:
-            print(f"An error occurred: {e}, trying to reconnect...")
-            time.sleep(1)
+    watcher = BoardWatcher()
+    devices = watcher.wait(args.board + 1)
+    watcher.close()
+    print("\aBalance board found.")
+    reader = MultiBoardReader(devices[args.board:args.board + 1])
+    path = board_path(args.calibration, args.board)
+    if args.stream:
+        # stream the calibrated sensor values to the serial port
+        calibration = Calibration.load(path)
+        engine = AcquisitionEngine(reader, lambda board: calibration)
+        engine.add(SerialSink('/dev/ttyGS0', 9600, encode_text))
+        if args.cpu_report:
+            engine.add(StatsSink(args.cpu_report, reader))
+        engine.run()
+    else:
+        sink = CollectSink()
+        engine = AcquisitionEngine(reader)
+        engine.add(sink, start=False)
+        engine.start()
+        calibrate(sink, path, args.samples)
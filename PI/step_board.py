@@ -0,0 +1,377 @@
+"""
+Event driven access to the Wii Balance Board.
+Code is based on:
+https://github.com/jmahmood/bbev/tree/main
+https://pypi.org/project/weii/0.1.1/
+"""
+import os
+import time
+import ctypes
+import ctypes.util
+import struct
+import selectors
+from typing import Optional
+import evdev
+from evdev import ecodes
+
+BOARD_NAME = "Nintendo Wii Remote Balance Board"
+INPUT_DIR = '/dev/input'
+
+# inotify event masks, see inotify(7)
+IN_ATTRIB = 0x004
+IN_CREATE = 0x100
+_INOTIFY_EVENT = struct.Struct('iIII')
+
+# evdev axis of every sensor, in the order top left, top right, bottom left, bottom right
+SENSOR_AXES = (ecodes.ABS_HAT1X, ecodes.ABS_HAT0X, ecodes.ABS_HAT0Y, ecodes.ABS_HAT1Y)
+
+
+class ButtonPressed(Exception):
+    """The user pressed the button of a board while measuring."""
+
+
+def get_board_devices(exclude=(), input_dir: str = INPUT_DIR) -> list:
+    """ Return all connected Wii Balance Board devices, in the order the kernel registered them. """
+    boards = []
+    for path in sorted(evdev.list_devices(input_dir)):
+        if path in exclude:
+            continue
+        try:
+            device = evdev.InputDevice(path)
+        except OSError:
+            # the device node exists but udev did not set its permissions yet, or it is gone again
+            continue
+        if device.name == BOARD_NAME:
+            boards.append(device)
+        else:
+            device.close()
+    return boards
+
+
+class BoardWatcher:
+    """
+    Watches the input device directory with inotify, so a board is attached the moment the kernel and udev create
+    its device node instead of polling for it. The watcher has a file descriptor that can be registered in a selector
+    next to the boards themselves.
+    """
+
+    def __init__(self, input_dir: str = INPUT_DIR):
+        self.input_dir = input_dir
+        self.attached = set()  # device paths in use
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # device nodes are created by the kernel and made readable by udev afterwards, watch for both
+        if libc.inotify_add_watch(self._fd, input_dir.encode(), IN_CREATE | IN_ATTRIB) < 0:
+            error = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(error, f"Cannot watch {input_dir}")
+
+    def fileno(self) -> int:
+        return self._fd
+
+    def scan(self) -> list:
+        """Return the boards that are not attached yet, and mark them attached."""
+        boards = get_board_devices(self.attached, self.input_dir)
+        self.attached.update(device.path for device in boards)
+        return boards
+
+    def poll(self) -> list:
+        """Handle the pending inotify events, returns the boards that appeared."""
+        changed = False
+        while True:
+            try:
+                data = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            pos = 0
+            while pos < len(data):
+                _, mask, _, length = _INOTIFY_EVENT.unpack_from(data, pos)
+                name = data[pos + _INOTIFY_EVENT.size:pos + _INOTIFY_EVENT.size + length].rstrip(b'\0')
+                pos += _INOTIFY_EVENT.size + length
+                if name.startswith(b'event') and mask & (IN_CREATE | IN_ATTRIB):
+                    changed = True
+        return self.scan() if changed else []
+
+    def wait(self, count: int = 1, timeout: Optional[float] = None) -> list:
+        """Wait until at least `count` boards are attached, returns the boards found (fewer on a timeout)."""
+        boards = self.scan()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with selectors.DefaultSelector() as selector:
+            selector.register(self._fd, selectors.EVENT_READ)
+            while len(boards) < count:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    break
+                if selector.select(remaining):
+                    boards += self.poll()
+        return boards
+
+    def release(self, path: str):
+        """Forget a device that disconnected, so it is attached again when it comes back."""
+        self.attached.discard(path)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class BoardReader:
+    """
+    Assembles the events of one board into complete measurements, one per SYN_REPORT. MultiBoardReader waits for the
+    device file descriptor to become readable and then reads all events at once with read_available(). A measurement
+    is a (seq, timestamp, values) tuple: seq numbers the reports of the board, the timestamp is the kernel time of the
+    SYN_REPORT event in seconds, the values are in decigrams, ordered as SENSOR_AXES.
+
+    The kernel only sends the axes whose value changed, so a report keeps the last value of the other sensors; the
+    sensor state is read from the device at the start. Reports that are not delivered leave a gap in seq: the reports
+    lost when the kernel's event buffer overflows (SYN_DROPPED). After an overflow the events up to the next
+    SYN_REPORT are discarded, the sensor state is read back from the device and the number of lost reports is
+    estimated from the report interval.
+    """
+
+    def __init__(self, device: evdev.InputDevice):
+        self.device = device
+        self._index = {code: i for i, code in enumerate(SENSOR_AXES)}
+        self._data = self._state()
+        self.incomplete = 0  # reports skipped because the value of a sensor was not known
+        self.syn_dropped = 0  # kernel event buffer overruns
+        self.lost = 0  # reports lost in the overruns, estimated
+        self.sequence = 0  # seq of the next report
+        self._dropping = False  # discarding events until the next SYN_REPORT after an overrun
+        self._last_time = None
+        self._interval = None  # running estimate of the report interval in seconds
+
+    def read_available(self) -> list:
+        """Read the events that are waiting without blocking, returns the measurements they complete."""
+        try:
+            events = list(self.device.read())
+        except BlockingIOError:
+            return []
+        measurements = []
+        for event in events:
+            measurement = self._handle(event)
+            if measurement is not None:
+                measurements.append(measurement)
+        return measurements
+
+    def _handle(self, event):
+        """Process one event, returns a measurement when the event completes one."""
+        if self._dropping:
+            if event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT:
+                return self._resync(event.timestamp())
+            return None
+        if event.type == ecodes.EV_ABS and event.code in self._index:
+            self._data[self._index[event.code]] = event.value
+        elif event.code == ecodes.BTN_A:
+            raise ButtonPressed("User pressed board button while measuring.")
+        elif event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT:
+            data = list(self._data)
+            timestamp = event.timestamp()
+            if self._last_time is not None:
+                interval = timestamp - self._last_time
+                if self._interval is None:
+                    self._interval = interval
+                elif interval < 5 * self._interval:
+                    self._interval += 0.05 * (interval - self._interval)
+            self._last_time = timestamp
+            if None in data:
+                # the state of a sensor could not be read at the start and it did not change since, nothing was lost
+                self.incomplete += 1
+                return None
+            seq = self.sequence
+            self.sequence += 1
+            return seq, timestamp, data
+        elif event.type == ecodes.EV_SYN and event.code == ecodes.SYN_DROPPED:
+            # the kernel dropped events: the values collected so far may belong to different reports
+            self.syn_dropped += 1
+            self._dropping = True
+        elif event.type == ecodes.EV_SYN:
+            pass
+        else:
+            print(f"ERROR: Got unexpected event: {evdev.categorize(event)}")
+        return None
+
+    def resume(self, previous: 'BoardReader'):
+        """
+        Continue the reports of a previous reader of the same board, after the board reconnected. The time the board
+        was gone is handled as an overrun, so the reports it did not deliver leave a gap in seq.
+        """
+        self.sequence = previous.sequence
+        self._last_time = previous._last_time
+        self._interval = previous._interval
+        self._dropping = True
+
+    def _resync(self, timestamp: float):
+        """End of an overrun: count the lost reports and read the current sensor state back from the device."""
+        self._dropping = False
+        if self._last_time is not None and self._interval:
+            lost = max(0, round((timestamp - self._last_time) / self._interval) - 1)
+            self.lost += lost
+            self.sequence += lost
+        self._last_time = timestamp
+        seq = self.sequence
+        self.sequence += 1
+        self._data = self._state()
+        if None in self._data:
+            self.incomplete += 1
+            return None
+        return seq, timestamp, list(self._data)
+
+    def _state(self) -> list:
+        """The current value of every sensor as the device reports it, None for a sensor that cannot be read."""
+        try:
+            return [self.device.absinfo(code).value for code in SENSOR_AXES]
+        except OSError:
+            return [None] * 4
+
+
+class MultiBoardReader:
+    """
+    Reads several boards at once from a single thread. All device file descriptors are registered in one selector,
+    so the reader wakes up for whichever board has events and never blocks on a quiet board. Measurements are
+    (board, seq, timestamp, values) tuples, where board is the index of the board in the order it was first attached
+    and seq numbers the reports of that board, see BoardReader.
+    The timestamps of all boards come from the same kernel clock, so they are aligned without conversion.
+
+    With a BoardWatcher the reader attaches boards as they appear. A board that drops out, for example when its
+    Bluetooth connection is lost, gets its old index back when it reconnects, and the reconnect time is logged.
+    """
+
+    def __init__(self, devices: list, watcher: Optional[BoardWatcher] = None):
+        self.readers = {}  # board index: reader, for the connected boards
+        self.watcher = watcher
+        self.selector = selectors.DefaultSelector()
+        self.reconnects = []  # seconds from losing a board until its first sample after reconnecting
+        self._boards = {}  # identity of a board: its index
+        self._lost = {}  # board index: time.monotonic() the board was lost
+        self._previous = {}  # board index: reader of a lost board
+        self._incomplete = 0
+        self._syn_dropped = 0
+        self._lost_reports = 0
+        if watcher is not None:
+            self.selector.register(watcher.fileno(), selectors.EVENT_READ, None)
+        for device in devices:
+            self.add(device)
+
+    @property
+    def boards(self) -> list:
+        """Indices of the boards that are connected."""
+        return sorted(self.readers)
+
+    @property
+    def incomplete(self) -> int:
+        return self._incomplete + sum(reader.incomplete for reader in self.readers.values())
+
+    @property
+    def syn_dropped(self) -> int:
+        return self._syn_dropped + sum(reader.syn_dropped for reader in self.readers.values())
+
+    @property
+    def lost(self) -> int:
+        return self._lost_reports + sum(reader.lost for reader in self.readers.values())
+
+    def add(self, device: evdev.InputDevice) -> int:
+        """Attach a board, returns its index."""
+        # the Bluetooth address identifies a board across reconnects, the device path does not
+        identity = device.uniq or device.phys or device.path
+        board = self._boards.setdefault(identity, len(self._boards))
+        self.readers[board] = BoardReader(device)
+        if board in self._previous:
+            self.readers[board].resume(self._previous.pop(board))
+        self.selector.register(device.fd, selectors.EVENT_READ, board)
+        if board in self._lost:
+            print(f"Board {board} is back after {time.monotonic() - self._lost[board]:.2f} s ({device.path}).")
+        else:
+            print(f"Board {board} attached ({device.path}).")
+        return board
+
+    def _remove(self, board: int, error: OSError):
+        reader = self.readers.pop(board)
+        print(f"Board {board} disconnected: {error}")
+        self.selector.unregister(reader.device.fd)
+        self._incomplete += reader.incomplete
+        self._syn_dropped += reader.syn_dropped
+        self._lost_reports += reader.lost
+        try:
+            reader.device.close()
+        except OSError:
+            pass
+        if self.watcher is not None:
+            self.watcher.release(reader.device.path)
+        self._lost[board] = time.monotonic()
+        self._previous[board] = reader
+
+    def read(self, timeout: Optional[float] = None) -> list:
+        """
+        Wait for at least one complete measurement of any board and return all measurements available.
+        Returns an empty list when the timeout expires. A board that disconnects is dropped. Without a watcher
+        OSError is raised when no board is left, with a watcher the reader waits for the boards to come back.
+        """
+        measurements = []
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not measurements:
+            if not self.readers and self.watcher is None:
+                raise OSError("All boards disconnected.")
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            ready = self.selector.select(remaining)
+            if not ready:
+                break
+            for key, _ in ready:
+                if key.data is None:
+                    for device in self.watcher.poll():
+                        self.add(device)
+                    continue
+                board = key.data
+                try:
+                    batch = self.readers[board].read_available()
+                except OSError as e:
+                    self._remove(board, e)
+                    continue
+                if batch and board in self._lost:
+                    reconnect = time.monotonic() - self._lost.pop(board)
+                    self.reconnects.append(reconnect)
+                    print(f"Board {board} reconnected, streaming again after {reconnect:.2f} s.")
+                measurements.extend((board, *measurement) for measurement in batch)
+        return measurements
+
+    def close(self):
+        self.selector.close()
+
+
+def cpu_temperature() -> float:
+    """Temperature of the Pi's SoC in degrees Celsius, NaN if it cannot be read."""
+    try:
+        with open('/sys/class/thermal/thermal_zone0/temp') as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return float('nan')
+
+
+class CpuMeter:
+    """Reports the CPU time this process spends per delivered sample."""
+
+    def __init__(self, interval: float = 10.0):
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self.samples = 0
+        self.start_wall = time.monotonic()
+        self.start_cpu = time.process_time()
+
+    def add(self, samples: int = 1):
+        """Count delivered samples, returns a report every interval seconds and None otherwise."""
+        self.samples += samples
+        if not self.interval or time.monotonic() - self.start_wall < self.interval:
+            return None
+        report = self.report()
+        self._reset()
+        return report
+
+    def report(self) -> str:
+        wall = time.monotonic() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        per_sample = cpu / self.samples * 1e6 if self.samples else float('nan')
+        return (f"CPU: {100 * cpu / wall:.1f}% of one core, {per_sample:.0f} us per sample, "
+                f"{self.samples / wall:.1f} samples/s")
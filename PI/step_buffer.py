@@ -0,0 +1,57 @@
+"""
+Ring buffer between the acquisition and the transmit side of the Pi sender.
+"""
+import threading
+from typing import Optional
+
+
+class RingBuffer:
+    """
+    Fixed capacity FIFO that is shared between one producer and one consumer thread.
+    The storage is allocated once. When the buffer is full the oldest sample is discarded to make room for the new
+    one; every discard is counted in `dropped`, so no sample is lost silently.
+    """
+
+    def __init__(self, capacity: int):
+        if capacity < 1:
+            raise ValueError("Capacity must be at least 1.")
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._head = 0  # index of the oldest item
+        self._count = 0
+        self._cond = threading.Condition()
+        self.pushed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def push(self, item):
+        """Add one item, discarding the oldest item if the buffer is full."""
+        with self._cond:
+            if self._count == self.capacity:
+                self._items[self._head] = None
+                self._head = (self._head + 1) % self.capacity
+                self._count -= 1
+                self.dropped += 1
+            self._items[(self._head + self._count) % self.capacity] = item
+            self._count += 1
+            self.pushed += 1
+            self._cond.notify()
+
+    def pop(self, max_items: int, min_items: int = 1, timeout: Optional[float] = None) -> list:
+        """
+        Remove and return up to max_items of the oldest items.
+        Waits until at least min_items are available or the timeout expires, in which case fewer (possibly no)
+        items are returned.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._count >= min_items, timeout)
+            n = min(self._count, max_items)
+            out = []
+            for _ in range(n):
+                out.append(self._items[self._head])
+                self._items[self._head] = None
+                self._head = (self._head + 1) % self.capacity
+            self._count -= n
+            return out
@@ -0,0 +1,87 @@
+"""
+Per-sensor calibration of the Wii Balance Board.
+
+The calibrated value of a sensor is (raw - offset) * gain. Offsets are captured with a tare of the unloaded board,
+gains are fitted from measurements with known weights (see accuracytest.py). The calibration is stored as JSON, one
+file per board.
+"""
+import os
+import json
+import numpy as np
+
+DEFAULT_PATH = os.path.expanduser('~/step_calibration.json')
+
+
+def board_path(path: str, board: int) -> str:
+    """Calibration file of a board: the first board uses the path itself, the others get their index appended."""
+    if board == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}_{board}{ext}"
+
+
+class Calibration:
+    """Tare offsets and gains of the four sensors, applied to whole batches of raw values at once."""
+
+    def __init__(self, offsets=None, gains=None):
+        self.offsets = np.zeros(4) if offsets is None else np.asarray(offsets, dtype=np.float64)
+        self.gains = np.ones(4) if gains is None else np.asarray(gains, dtype=np.float64)
+        self.path = None  # file the calibration is saved to after a tare
+        self._tare = None  # samples still needed and the sums collected for a tare in progress
+
+    def apply(self, raw):
+        """Calibrate a (n, 4) array of raw sensor values, collecting them first if a tare is in progress."""
+        raw = np.asarray(raw, dtype=np.float64).reshape(-1, 4)
+        if self._tare is not None:
+            self._collect(raw)
+        return (raw - self.offsets) * self.gains
+
+    def tare(self, samples: int = 50):
+        """Start a tare: the offsets become the mean of the next `samples` raw values."""
+        self._tare = [samples, np.zeros(4), 0]
+
+    def _collect(self, raw):
+        needed, sums, count = self._tare
+        raw = raw[:needed - count]
+        sums += raw.sum(axis=0)
+        count += len(raw)
+        if count < needed:
+            self._tare = [needed, sums, count]
+            return
+        self.offsets = sums / count
+        self._tare = None
+        print(f"Tare done, offsets: {self.offsets.round(1).tolist()}")
+        if self.path:
+            self.save(self.path)
+
+    @staticmethod
+    def fit_gains(raw, weights, offsets=None):
+        """
+        Fit the gains from measurements with known weights: raw is a (n, 4) array with the mean raw values of n
+        measurements, weights the known weight of each measurement in board units (1/100 kg). At least four
+        measurements with the weight at different positions are needed. Returns the gains and the residual error of
+        every measurement.
+        """
+        raw = np.asarray(raw, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(raw) < 4:
+            raise ValueError("At least four measurements are needed to fit the gains.")
+        loads = raw - (np.zeros(4) if offsets is None else offsets)
+        gains, *_ = np.linalg.lstsq(loads, weights, rcond=None)
+        return gains, loads @ gains - weights
+
+    def save(self, path: str = DEFAULT_PATH):
+        with open(path, 'w') as f:
+            json.dump({"offsets": self.offsets.tolist(), "gains": self.gains.tolist()}, f, indent=4)
+
+    @classmethod
+    def load(cls, path: str = DEFAULT_PATH):
+        """Load the calibration from a file, returns an identity calibration if the file does not exist."""
+        if os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            calibration = cls(data.get("offsets"), data.get("gains"))
+        else:
+            calibration = cls()
+        calibration.path = path
+        return calibration
@@ -0,0 +1,371 @@
+"""
+Acquisition engine of the Pi: reads the boards once and hands every measurement to any number of sinks at once.
+
+The engine only reads and calibrates, in its own thread. Every sink has its own ring buffer and its own thread, so a
+slow sink (a congested serial link, a viewer on a bad network) discards its own oldest samples but never stalls
+the acquisition or the other sinks. Samples are (board, seq, timestamp, values) tuples as MultiBoardReader delivers
+them, with the values calibrated if the engine has a calibration.
+
+The scripts on the Pi are configurations of the engine: step_pi_sender.py streams to the viewer, accuracytest.py
+calibrates or streams calibrated values and bluetoothreceivetimer.py only collects statistics.
+"""
+import os
+import time
+import threading
+from collections import defaultdict
+from typing import Callable, Optional
+import serial
+from step_board import MultiBoardReader, CpuMeter, ButtonPressed
+from step_buffer import RingBuffer
+from step_file import RecordingWriter
+
+# bytes waiting in the output queue of a link above which the link is considered congested
+HIGH_WATER = 4096
+# longest time a sample waits in the buffer of a sink for a batch to fill up
+MAX_LATENCY = 0.02
+
+
+class Sink:
+    """
+    Consumer of the samples of the engine. put() only queues the samples, they are handed to write() in batches of
+    min_batch to max_batch samples from the sink's own thread. An optional process callable transforms every batch
+    first, for example to decimate it. Subclasses implement write(), and idle() for work that is due even when no
+    samples arrive; a sink that cannot take samples for a while returns False from ready(), its samples wait in the
+    ring buffer meanwhile. A sink that wants no more samples sets done, the engine then drops it.
+    """
+
+    def __init__(self, capacity: int = 1000, min_batch: int = 1, max_batch: int = 64,
+                 process: Optional[Callable[[list], list]] = None):
+        self.ring = RingBuffer(capacity)
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.batch = min_batch  # current batch size
+        self.process = process
+        self.done = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def name(self) -> str:
+        return type(self).__name__
+
+    def put(self, samples: list):
+        for sample in samples:
+            self.ring.push(sample)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        """Stop the sink once it handled the samples it has, and wait for its thread."""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def finished(self) -> bool:
+        # a stopped sink that cannot take its last samples does not wait for them
+        return self.done or (self._stop.is_set() and (not len(self.ring) or not self.ready()))
+
+    def run(self):
+        """Handle the samples until the sink is stopped, can also be called from the main thread."""
+        try:
+            while not self.finished():
+                if self.ready():
+                    samples = self.ring.pop(self.max_batch, min_items=min(self.batch, self.max_batch),
+                                            timeout=MAX_LATENCY)
+                    if samples and self.process is not None:
+                        samples = self.process(samples)
+                    if samples:
+                        self.write(samples)
+                self.idle()
+        except Exception as e:
+            print(f"{self.name} stopped: {e}")
+        finally:
+            self.done = True
+            self.close()
+
+    def write(self, samples: list):
+        raise NotImplementedError
+
+    def ready(self) -> bool:
+        return True
+
+    def idle(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamSink(Sink):
+    """
+    Writes the encoded samples to a byte stream, a serial port or a file. encode turns one sample into bytes.
+    The batch size adapts to the link: it grows quickly while the output queue is backed up and shrinks slowly when
+    it is drained. While the link is congested the samples wait in the sink's ring buffer, where discards are counted.
+    A write that times out, because nobody reads the other end of the link, is congestion as well: the data is sent
+    again before anything else, and no samples are taken from the ring until the link takes it.
+    """
+
+    def __init__(self, stream, encode: Callable[..., bytes], **kwargs):
+        super().__init__(**kwargs)
+        self.stream = stream
+        self.encode = encode
+        self.bytes_written = 0
+        self.unsent = b''  # data of a write that timed out
+
+    def message(self, samples: list) -> bytes:
+        return b''.join(self.encode(*sample) for sample in samples)
+
+    def write(self, samples: list):
+        self.send(self.message(samples))
+        self.adapt()
+
+    def send(self, data: bytes):
+        data, self.unsent = self.unsent + data, b''
+        if data:
+            try:
+                self.stream.write(data)
+            except serial.SerialTimeoutException:
+                self.unsent = data
+                return
+            self.bytes_written += len(data)
+
+    def ready(self) -> bool:
+        if self.unsent:
+            # waits up to the write timeout of the stream
+            self.send(b'')
+        return not self.unsent
+
+    def pending(self) -> int:
+        """Bytes waiting in the output queue of the stream."""
+        try:
+            return self.stream.out_waiting
+        except (AttributeError, OSError, NotImplementedError):
+            return 0
+
+    def drain(self) -> bool:
+        """Wait until the output queue is below HIGH_WATER, returns False if the stream does not take data."""
+        if not self.ready():
+            return False
+        while self.pending() > HIGH_WATER:
+            time.sleep(0.005)
+        return True
+
+    def adapt(self):
+        if self.pending() > HIGH_WATER:
+            self.batch = min(self.batch * 2, self.max_batch)
+            self.drain()
+        elif self.batch > self.min_batch:
+            self.batch -= 1
+
+
+class SerialSink(StreamSink):
+    """Stream to a serial port, the port is opened again when it fails, for example when the USB gadget resets."""
+
+    def __init__(self, port: str, baudrate: int, encode: Callable[..., bytes], **kwargs):
+        super().__init__(None, encode, **kwargs)
+        self.port = port
+        self.baudrate = baudrate
+
+    def send(self, data: bytes):
+        if self.stream is None:
+            try:
+                print("Opening serial port...")
+                self.stream = serial.Serial(self.port, self.baudrate, timeout=1, write_timeout=1)
+                print(f"Serial port {self.stream.name} opened.")
+            except serial.SerialException as e:
+                print(f"An error occurred: {e}, trying to reconnect...")
+                time.sleep(1)
+                return
+        try:
+            super().send(data)
+        except serial.SerialException as e:
+            print(f"An error occurred: {e}, trying to reconnect...")
+            self.close()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+
+class FileSink(Sink):
+    """
+    Records the samples into a preallocated .step file (see step_file.py), for a number of seconds from the first
+    sample. transform converts the values of a sample before they are written, on_complete is called with the closed
+    RecordingWriter.
+    """
+
+    def __init__(self, path: str, frame_type: int, seconds: float, capacity: int,
+                 transform: Optional[Callable] = None, on_complete: Optional[Callable] = None, **kwargs):
+        kwargs.setdefault('max_batch', 256)
+        super().__init__(**kwargs)
+        self.path = path
+        self.frame_type = frame_type
+        self.seconds = seconds
+        self.capacity = capacity
+        self.transform = transform
+        self.on_complete = on_complete
+        self.writer = None
+
+    def write(self, samples: list):
+        for board, seq, timestamp, values in samples:
+            if self.writer is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                print(f"Recording {self.seconds} s trial to {self.path}...")
+                self.writer = RecordingWriter(self.path, self.frame_type, self.capacity, timestamp)
+            if timestamp - self.writer.start_time < self.seconds:
+                self.writer.write(seq, timestamp, values if self.transform is None else self.transform(values), board)
+            if timestamp - self.writer.start_time >= self.seconds or self.writer.full:
+                self.done = True
+                return
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        print(f"Trial recorded, {self.writer.count} samples.")
+        if self.on_complete is not None:
+            self.on_complete(self.writer)
+        self.writer = None
+
+
+class StatsSink(Sink):
+    """
+    Counts the samples and the lost samples (gaps in seq) per board, and prints them with the CPU usage every interval
+    seconds. details is an optional callable whose text is added to the report.
+    """
+
+    def __init__(self, interval: float = 10.0, reader: Optional[MultiBoardReader] = None,
+                 details: Optional[Callable[[], str]] = None, **kwargs):
+        kwargs.setdefault('max_batch', 256)
+        super().__init__(**kwargs)
+        self.reader = reader
+        self.details = details
+        self.cpumeter = CpuMeter(interval)
+        self.samples = defaultdict(int)
+        self.lost = defaultdict(int)
+        self._last_seq = {}
+
+    def write(self, samples: list):
+        for board, seq, _, _ in samples:
+            if board in self._last_seq and seq > self._last_seq[board] + 1:
+                self.lost[board] += seq - self._last_seq[board] - 1
+            self._last_seq[board] = seq
+            self.samples[board] += 1
+        report = self.cpumeter.add(len(samples))
+        if report:
+            print(self.report(report))
+
+    def report(self, cpu: str) -> str:
+        report = cpu + ''.join(f", board {board}: {count} samples, {self.lost[board]} lost"
+                               for board, count in sorted(self.samples.items()))
+        if self.reader is not None and self.reader.reconnects:
+            reconnects = self.reader.reconnects
+            report += (f", {len(reconnects)} reconnects, mean {sum(reconnects) / len(reconnects):.2f} s, "
+                       f"longest {max(reconnects):.2f} s")
+        if self.details is not None:
+            report += f", {self.details()}"
+        return report
+
+
+class CollectSink(Sink):
+    """Collects the samples for the caller's thread to take, it is added to the engine without starting it."""
+
+    def clear(self):
+        """Discard the samples that were collected so far."""
+        self.ring.pop(self.ring.capacity, min_items=0, timeout=0)
+
+    def take(self, count: int) -> list:
+        """Wait for the next count samples."""
+        samples = []
+        while len(samples) < count:
+            samples.extend(self.ring.pop(count - len(samples)))
+        return samples
+
+
+class AcquisitionEngine:
+    """
+    Reads all boards and distributes every batch of measurements to the sinks. calibration is an optional callable
+    that returns the Calibration of a board, without one the sinks get the raw sensor values.
+    """
+
+    def __init__(self, reader: MultiBoardReader, calibration: Optional[Callable] = None):
+        self.reader = reader
+        self.calibration = calibration
+        self.sinks = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, sink: Sink, start: bool = True) -> Sink:
+        """
+        Give a sink the samples from now on, sinks can be added while the engine runs. A sink that is not started
+        runs in the caller's thread, see Sink.run and CollectSink.
+        """
+        if start:
+            sink.start()
+        with self._lock:
+            self.sinks.append(sink)
+        return sink
+
+    def remove(self, sink: Sink):
+        with self._lock:
+            if sink in self.sinks:
+                self.sinks.remove(sink)
+
+    def process(self, measurements: list) -> list:
+        """Calibrate the measurements, the whole batch of a board in one step."""
+        if self.calibration is None:
+            return measurements
+        samples = []
+        for board in sorted(set(board for board, _, _, _ in measurements)):
+            batch = [measurement for measurement in measurements if measurement[0] == board]
+            values = self.calibration(board).apply([data for _, _, _, data in batch]).tolist()
+            samples.extend((board, seq, timestamp, data) for (_, seq, timestamp, _), data in zip(batch, values))
+        return samples
+
+    def run(self):
+        """
+        Read and distribute the measurements until no board is left, the button of a board is pressed or the
+        acquisition fails, then let the sinks finish.
+        """
+        try:
+            while True:
+                try:
+                    measurements = self.reader.read()
+                except OSError as e:
+                    print(f"Board disconnected: {e}")
+                    break
+                except ButtonPressed as e:
+                    print(f"ERROR: {e} Aborting.")
+                    break
+                samples = self.process(measurements)
+                with self._lock:
+                    sinks = list(self.sinks)
+                for sink in sinks:
+                    if sink.done:
+                        self.remove(sink)
+                    else:
+                        sink.put(samples)
+        except Exception as e:
+            print(f"Acquisition stopped: {e}")
+        finally:
+            # the sinks, also the one that runs in the main thread, finish even when the acquisition failed
+            self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='acquisition')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def stop(self):
+        """Stop all sinks after they handled the samples they have."""
+        with self._lock:
+            sinks, self.sinks = self.sinks, []
+        for sink in sinks:
+            sink.stop(timeout=5)
@@ -0,0 +1,102 @@
+"""
+Binary recording file (.step) written on the Pi and read by the STEP viewer.
+
+The file starts with a 32 byte header:
+
+    offset  size  field
+    0       4     magic (b'STEP')
+    4       1     version
+    5       1     frame type of the samples (see step_protocol)
+    6       2     reserved
+    8       4     capacity in samples
+    12      4     number of recorded samples
+    16      8     start time in seconds (board clock)
+    24      8     reserved
+
+followed by the samples, each a board id (uint8), a sequence number (uint32), a board timestamp (float64) and the
+payload fields of the frame type. Version 1 files have no board id, all their samples are from board 0. All fields are
+little-endian.
+"""
+import os
+import struct
+import numpy as np
+try:
+    from step_protocol import PAYLOAD_FIELDS
+except ImportError:  # imported by the viewer from the repository root
+    from PI.step_protocol import PAYLOAD_FIELDS
+
+
+MAGIC = b'STEP'
+VERSION = 2
+HEADER = struct.Struct('<4sBBxxIId8x')
+
+
+def record_struct(frame_type: int) -> struct.Struct:
+    return struct.Struct('<BId' + ''.join(f for _, f in PAYLOAD_FIELDS[frame_type]))
+
+
+def record_dtype(frame_type: int, version: int = VERSION):
+    """Return the NumPy structured dtype of one sample in the file."""
+    fields = [('board', 'u1')] if version >= 2 else []
+    fields += [('seq', '<u4'), ('time', '<f8')]
+    fields += [(name, '<' + f) for name, f in PAYLOAD_FIELDS[frame_type]]
+    return np.dtype(fields)
+
+
+class RecordingWriter:
+    """
+    Writes samples at the board's native rate into a file that is preallocated for `capacity` samples,
+    so the recording never has to grow the file while the trial runs.
+    """
+
+    def __init__(self, path: str, frame_type: int, capacity: int, start_time: float):
+        self.path = path
+        self.frame_type = frame_type
+        self.capacity = capacity
+        self.start_time = start_time
+        self.count = 0
+        self._record = record_struct(frame_type)
+        self._file = open(path, 'w+b')
+        size = HEADER.size + capacity * self._record.size
+        try:
+            os.posix_fallocate(self._file.fileno(), 0, size)
+        except (AttributeError, OSError):
+            self._file.truncate(size)
+        self._write_header()
+
+    def _write_header(self):
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, self.frame_type, self.capacity, self.count, self.start_time))
+        self._file.seek(HEADER.size + self.count * self._record.size)
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def write(self, seq: int, timestamp: float, values, board: int = 0) -> bool:
+        """Append one sample, returns False if the file is full and the sample was not written."""
+        if self.full:
+            return False
+        self._file.write(self._record.pack(board, seq & 0xFFFFFFFF, timestamp, *values))
+        self.count += 1
+        return True
+
+    def close(self):
+        """Write the final sample count, cut off the unused part of the file and sync it to disk."""
+        self._write_header()
+        self._file.truncate(HEADER.size + self.count * self._record.size)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+
+def read_recording(data: bytes):
+    """Parse the contents of a .step file, returns the header as a dict and the samples as a structured array."""
+    magic, version, frame_type, capacity, count, start_time = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a STEP recording.")
+    if version not in (1, VERSION):
+        raise ValueError(f"Unsupported STEP recording version: {version}")
+    header = {"frame_type": frame_type, "capacity": capacity, "count": count, "start_time": start_time}
+    samples = np.frombuffer(data, dtype=record_dtype(frame_type, version), count=count, offset=HEADER.size)
+    return header, samples
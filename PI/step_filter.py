@@ -0,0 +1,111 @@
+"""
+Streaming low-pass filter for the sensor values, applied on the Pi before the stream is decimated to its output rate.
+
+The filter is a Butterworth low-pass built from a cascade of biquad sections (direct form II transposed). Its state is
+kept between batches, so filtering a stream batch by batch gives the same result as filtering it in one go. The cutoff
+is lowered to below the Nyquist frequency of the output rate when the stream is decimated, so decimating the filtered
+stream does not alias.
+"""
+import math
+import numpy as np
+
+# fraction of the output rate the cutoff is limited to when the stream is decimated
+ANTI_ALIAS = 0.4
+# number of sample intervals used to measure the board's native rate before the filter is designed
+RATE_SAMPLES = 50
+# a pause in the input of this many sample intervals restarts the filter, for example after a board reconnects
+RESTART_INTERVALS = 10
+
+
+def butterworth_sections(cutoff: float, rate: float, order: int = 4) -> np.ndarray:
+    """
+    Coefficients of a Butterworth low-pass of an even order as a cascade of order / 2 biquads.
+    Returns a (sections, 5) array with b0, b1, b2, a1, a2 of every section, normalized to a0 = 1.
+    """
+    if order < 2 or order % 2:
+        raise ValueError("The filter order must be an even number of at least 2.")
+    w0 = 2 * math.pi * cutoff / rate
+    sections = []
+    for k in range(order // 2):
+        # quality factor of the k-th pole pair of the Butterworth polynomial
+        q = 1 / (2 * math.cos((2 * k + 1) * math.pi / (2 * order)))
+        alpha = math.sin(w0) / (2 * q)
+        cos_w0 = math.cos(w0)
+        a0 = 1 + alpha
+        sections.append([(1 - cos_w0) / 2 / a0, (1 - cos_w0) / a0, (1 - cos_w0) / 2 / a0,
+                         -2 * cos_w0 / a0, (1 - alpha) / a0])
+    return np.array(sections)
+
+
+class LowPassFilter:
+    """
+    Low-pass filter for a stream of samples with several channels, for example the four sensors of one board.
+    The board's native rate is measured from the timestamps of the first samples, until then samples pass unfiltered.
+    After a pause in the input the filter restarts from the first new sample, so old state does not leak into it.
+    """
+
+    def __init__(self, cutoff: float, order: int = 4):
+        self.cutoff = cutoff
+        self.order = order
+        self.rate = None  # native rate of the input in Hz, measured
+        self.output_rate = 0
+        self.sections = None
+        self._state = None  # (sections, 2, channels)
+        self._intervals = []
+        self._last_time = None
+
+    def design(self, output_rate: float = 0):
+        """Design the sections for the measured input rate, limiting the cutoff when the stream is decimated."""
+        cutoff = self.cutoff
+        if output_rate:
+            cutoff = min(cutoff, ANTI_ALIAS * output_rate)
+        cutoff = min(cutoff, 0.45 * self.rate)
+        self.output_rate = output_rate
+        self.sections = butterworth_sections(cutoff, self.rate, self.order)
+        self._state = None
+        print(f"Low-pass filter: {self.order}th order at {cutoff:.1f} Hz, input {self.rate:.1f} Hz")
+
+    def _measure(self, timestamps):
+        if self._last_time is not None:
+            timestamps = np.concatenate(([self._last_time], timestamps))
+        self._intervals.extend(np.diff(timestamps).tolist())
+        if len(self._intervals) >= RATE_SAMPLES:
+            self.rate = 1 / float(np.median(self._intervals))
+            self._intervals = []
+
+    def _reset_state(self, value):
+        """Start the filter in its steady state for a constant input `value`, this avoids a start-up transient."""
+        b0, b1, b2, a1, a2 = self.sections.T
+        z2 = np.outer(b2 - a2, value)
+        z1 = np.outer(b1 - a1, value) + z2
+        self._state = np.stack((z1, z2), axis=1)
+
+    def apply(self, timestamps, values, output_rate: float = 0):
+        """Filter a (n, channels) batch of samples, returns the filtered batch."""
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return values
+        if self.rate is None:
+            self._measure(np.asarray(timestamps, dtype=np.float64))
+            if self.rate is None:
+                self._last_time = timestamps[-1]
+                return values
+        elif timestamps[0] - self._last_time > RESTART_INTERVALS / self.rate:
+            self._state = None
+        self._last_time = timestamps[-1]
+        if self.sections is None or output_rate != self.output_rate:
+            self.design(output_rate)
+        if self._state is None:
+            self._reset_state(values[0])
+        out = np.empty_like(values)
+        state = self._state
+        coefficients = self.sections.tolist()
+        for i, x in enumerate(values):
+            for s, (b0, b1, b2, a1, a2) in enumerate(coefficients):
+                z1, z2 = state[s]
+                y = b0 * x + z1
+                state[s, 0] = b1 * x - a1 * y + z2
+                state[s, 1] = b2 * x - a2 * y
+                x = y
+            out[i] = x
+        return out
@@ -0,0 +1,154 @@
+"""
+Network transport of the Pi sender, next to the USB gadget serial port.
+
+Over TCP the sender accepts one viewer at a time, over UDP it streams to the address the last datagram came from, so
+the viewer says hello when it starts. The connections offer the part of the pyserial interface the sender uses,
+write(), readline(), flush() and out_waiting, so the link, the commands and the flow control work the same on every
+transport. The frames are the same as on the serial port: they are found by their sync bytes and checked by their
+CRC, so a datagram that is lost only leaves a gap in the sequence numbers.
+"""
+import fcntl
+import socket
+import struct
+import termios
+import time
+
+# port the sender listens on
+DEFAULT_PORT = 8765
+# largest UDP payload, below the Ethernet MTU so datagrams are not fragmented
+MAX_DATAGRAM = 1400
+# seconds without a datagram from the viewer after which it is considered gone, the viewer says hello every second
+PEER_TIMEOUT = 5.0
+
+
+class TcpConnection:
+    """A viewer connected over TCP."""
+    baudrate = None
+
+    def __init__(self, sock: socket.socket, address):
+        self.sock = sock
+        self.name = f"tcp://{address[0]}:{address[1]}"
+        self.is_open = True
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # notice a viewer that disappears without closing the connection
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self._file = sock.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readline(self) -> bytes:
+        line = self._file.readline()
+        if not line:
+            # the viewer closed the connection
+            self.is_open = False
+        return line
+
+    def write(self, data: bytes) -> int:
+        self.sock.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    @property
+    def out_waiting(self) -> int:
+        """Bytes the viewer did not acknowledge yet, the TCP send queue works as the driver queue of a serial port."""
+        return struct.unpack('i', fcntl.ioctl(self.sock, termios.TIOCOUTQ, b'\0\0\0\0'))[0]
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._file.close()
+        self.sock.close()
+
+
+class TcpServer:
+    """Listens for viewers on a TCP port."""
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = ''):
+        self.sock = socket.create_server((host, port))
+        self.sock.settimeout(1)
+        print(f"Listening on TCP port {self.sock.getsockname()[1]}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def accept(self):
+        """Wait up to a second for a viewer, returns its connection or None."""
+        try:
+            sock, address = self.sock.accept()
+        except socket.timeout:
+            return None
+        sock.settimeout(None)
+        return TcpConnection(sock, address)
+
+    def close(self):
+        self.sock.close()
+
+
+class UdpConnection:
+    """
+    Streams to the viewer over UDP. Every datagram from the viewer holds command lines, possibly just an empty line
+    to say hello; until the first one arrives the stream is discarded. The viewer keeps saying hello while it reads,
+    so a viewer that is silent for PEER_TIMEOUT is gone and the stream is discarded again until the next one says
+    hello. Writes are split into datagrams of at most MAX_DATAGRAM bytes.
+    """
+    baudrate = None
+    out_waiting = 0
+
+    def __init__(self, port: int = DEFAULT_PORT, host: str = ''):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.name = f"udp://{host or '*'}:{self.sock.getsockname()[1]}"
+        self.is_open = True
+        self.peer = None
+        self.heard = 0.0  # time the last datagram of the peer arrived
+        self._lines = []
+        print(f"Listening on UDP port {self.sock.getsockname()[1]}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def readline(self) -> bytes:
+        while not self._lines:
+            data, address = self.sock.recvfrom(65536)
+            self.heard = time.monotonic()
+            if address != self.peer:
+                print(f"Streaming to {address[0]}:{address[1]} over UDP.")
+                self.peer = address
+            self._lines = data.splitlines(keepends=True) or [b'\n']
+        return self._lines.pop(0)
+
+    def write(self, data: bytes) -> int:
+        peer = self.peer
+        if peer is None:
+            return 0
+        if time.monotonic() - self.heard > PEER_TIMEOUT:
+            # an unconnected socket does not learn that the viewer is gone, its silence tells
+            print(f"Viewer {peer[0]}:{peer[1]} went silent, waiting for the next one to say hello.")
+            self.peer = None
+            return 0
+        for i in range(0, len(data), MAX_DATAGRAM):
+            self.sock.sendto(data[i:i + MAX_DATAGRAM], peer)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+        self.sock.close()
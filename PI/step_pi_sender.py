@@ -1,102 +1,491 @@
-import sys
+import os
 import time
-from typing import Optional
-import evdev
-from evdev import ecodes
+import queue
+import argparse
+from collections import defaultdict
+from threading import Thread
 from serial import Serial
+from step_board import BoardWatcher, MultiBoardReader, cpu_temperature
+from step_calibration import Calibration, DEFAULT_PATH, board_path
+from step_engine import AcquisitionEngine, StreamSink, FileSink, StatsSink, HIGH_WATER
+from step_filter import LowPassFilter
+from step_net import DEFAULT_PORT, TcpServer, UdpConnection
+from step_file import HEADER, record_struct
+from step_protocol import FRAME_COP, FRAME_RAW, FRAME_RESPONSE, FRAME_TELEMETRY, COMMANDS, STATUS_OK, STATUS_ERROR, \
+    MAX_FILE_SIZE, encode_frame, encode_text, encode_file, parse_command, test_pattern
 
-def get_board_device() -> Optional[evdev.InputDevice]:
-    """ Return the Wii Balance Board device. """
-    devices = [
-        path
-        for path in evdev.list_devices()
-        if evdev.InputDevice(path).name == "Nintendo Wii Remote Balance Board"
-    ]
-    if not devices:
-        return None
+# highest sample rate the local recording file is preallocated for
+MAX_BOARD_RATE = 500
+# number of samples averaged for a tare
+TARE_SAMPLES = 50
+# seconds a new baud rate has to be confirmed in, otherwise the link falls back to the previous rate
+BAUD_CONFIRM = 2.0
+# seconds without a command from the viewer after which a negotiated baud rate falls back to --baudrate, three ping
+# intervals of the viewer, so the next viewer finds the link at the rate it opens the port with
+LINK_TIMEOUT = 15.0
+# largest link test the viewer can ask for, in bytes
+MAX_TEST_SIZE = 1 << 20
 
-    board = evdev.InputDevice(
-        devices[0],
-    )
-    return board
 
+def compute_cop(data):
+    """Calculate the x and y center of pressure coordinates in mm from the four sensor values."""
+    length = 228
+    width = 433
+    total = sum(data)
+    if not total:
+        # nothing on the board (or exactly the tare load)
+        return [0.0, 0.0]
+    x_cop = width/2 * (data[1] + data[2] - data[0] - data[3]) / total
+    y_cop = length/2 * (data[0] + data[1] - data[2] - data[3]) / total
+    return [x_cop, y_cop]
+
+
+def encode_sample(protocol, mode, board, seq, timestamp, data) -> bytes:
+    if mode == 'raw':
+        # the viewer computes the center of pressure
+        return encode_frame(FRAME_RAW, seq, timestamp, data, board)
+    data = compute_cop(data)
+    if protocol == 'binary':
+        return encode_frame(FRAME_COP, seq, timestamp, data, board)
+    return encode_text([round(i, 4) for i in data] + [round(timestamp, 6)])
+
+
+class Settings:
+    """Stream settings, changed at runtime by commands from the viewer."""
+
+    def __init__(self, args, transfers: queue.Queue, boards: int = 1):
+        self.protocol = args.protocol
+        self.transport = args.transport
+        self.mode = args.mode
+        self.streaming = True
+        self.rate = args.rate  # output rate in Hz, 0 for the board's native rate
+        self.live_rate = args.live_rate
+        self.min_batch = args.min_batch
+        self.max_batch = args.max_batch
+        self.record_dir = args.record_dir
+        self.transfers = transfers
+        self.boards = boards
+        self.engine = None  # trials are recorded by a sink of the engine
+        self.trial = None
+        self.link = None  # link to the viewer that is connected
+        # per board state, created when a board first delivers samples since boards can be attached at any time
+        self.calibrations = {}
+        self._args = args
+        # baud rate negotiation: the rate of the link, a switch the transmit loop still has to make, and the rate
+        # to fall back to with its deadline while a new rate is not confirmed yet
+        self.baudrate = args.baudrate
+        self.baud_change = None
+        self.baud_fallback = None
+        self.default_baudrate = args.baudrate
+        self.last_command = time.monotonic()
 
-def get_raw_measurement(device: evdev.InputDevice):
+    def calibration(self, board: int) -> Calibration:
+        """Calibration of a board, every board has its own calibration file."""
+        if board not in self.calibrations:
+            self.calibrations[board] = Calibration.load(board_path(self._args.calibration, board))
+            if self._args.tare:
+                self.calibrations[board].tare(self._args.tare)
+            self.boards = max(self.boards, board + 1)
+        return self.calibrations[board]
+
+    def record(self, seconds: float):
+        """
+        Record a trial at the board's native rate into a preallocated file on the Pi. When the trial is complete the
+        file is queued for a bulk transfer to the viewer, the file itself is kept on the Pi. With several boards the
+        samples of all boards go into the same file, tagged with their board id. Raises ValueError if the file could
+        be larger than a bulk transfer.
+        """
+        path = os.path.join(self.record_dir, time.strftime("STEP_%Y%m%d_%H%M%S.step"))
+        frame_type = FRAME_RAW if self.mode == 'raw' else FRAME_COP
+        capacity = self.boards * (int(seconds * MAX_BOARD_RATE) + 1)
+        if HEADER.size + capacity * record_struct(frame_type).size > MAX_FILE_SIZE:
+            raise ValueError(f"a recording of {seconds} s does not fit in one transfer")
+        self.trial = FileSink(path, frame_type, seconds, capacity, None if self.mode == 'raw' else compute_cop,
+                              self.transfers.put)
+        self.engine.add(self.trial)
+
+    def recording(self) -> bool:
+        return self.trial is not None and not self.trial.done
+
+    def output_rate(self) -> float:
+        """Rate of the outgoing stream, reduced to the live rate while a trial is recorded."""
+        rates = [self.rate] if self.rate else []
+        if self.recording() and self.live_rate:
+            rates.append(self.live_rate)
+        return min(rates) if rates else 0
+
+    def handle(self, command: str, argument):
+        """Apply one command, returns the status and value of the response."""
+        if command == 'start':
+            self.streaming = True
+        elif command == 'stop':
+            self.streaming = False
+        elif command == 'rate':
+            self.rate = max(0.0, float(argument))
+            return STATUS_OK, self.rate
+        elif command == 'batch':
+            self.max_batch = max(self.min_batch, int(argument))
+            return STATUS_OK, self.max_batch
+        elif command == 'mode':
+            if argument not in ('cop', 'raw') or (argument == 'raw' and self.protocol != 'binary'):
+                return STATUS_ERROR, 0
+            self.mode = argument
+        elif command == 'tare':
+            # the acquisition thread adds the calibration of a board that appears, tare the boards known now
+            for calibration in list(self.calibrations.values()):
+                calibration.tare(TARE_SAMPLES)
+        elif command == 'ping':
+            return STATUS_OK, time.time()
+        elif command == 'record':
+            if self.recording():
+                return STATUS_ERROR, 0
+            self.record(float(argument))
+        elif command == 'baud':
+            baudrate = int(argument)
+            if baudrate <= 0 or self.transport != 'serial':
+                return STATUS_ERROR, 0
+            if baudrate == self.baudrate and self.baud_fallback is not None:
+                # the viewer repeats the rate once the link test passed, keep it
+                self.baud_fallback = None
+                print(f"Baud rate {baudrate} confirmed.")
+            return STATUS_OK, baudrate
+        elif command == 'test':
+            size = int(argument)
+            if not 0 < size <= MAX_TEST_SIZE:
+                return STATUS_ERROR, 0
+            return STATUS_OK, size
+        return STATUS_OK, 0
+
+
+class LiveStream:
     """
-    Read one measurement from the board.
-    Code is based on:
-    https://github.com/jmahmood/bbev/tree/main
-    https://pypi.org/project/weii/0.1.1/
+    Turns the calibrated samples of the engine into the live stream to the viewer. The stream is low-pass filtered
+    first if a filter is configured, and decimated to the output rate on a fixed time grid, so the output rate is
+    steady even though the board's rate is not. Every link has its own LiveStream, since filters keep state.
+    The sequence number counts the samples of a board in the outgoing stream, so a gap means lost samples: reports
+    the board did not deliver leave a gap of the samples they would have given in the stream.
     """
-    data = [None] * 4
-    length = 228
-    width = 433
-    tries = 50
-    while True:
-        event = device.read_one()
-        if event is None:
-            continue
-        # Measurements are in decigrams, so we convert them to kilograms here.
-        if event.code == ecodes.ABS_HAT1X:
-            # Top left.
-            data[0] = event.value
-        elif event.code == ecodes.ABS_HAT0X:
-            # Top right.
-            data[1] = event.value
-        elif event.code == ecodes.ABS_HAT0Y:
-            # Bottom left.
-            data[2] = event.value
-        elif event.code == ecodes.ABS_HAT1Y:
-            # Bottom right.
-            data[3] = event.value
-        elif event.code == ecodes.BTN_A:
-            sys.exit("ERROR: User pressed board button while measuring, aborting.")
-        elif event.code == ecodes.SYN_DROPPED:
-            pass
-        elif event.code == ecodes.SYN_REPORT and event.value == 3:
-            pass
-        elif event.code == ecodes.SYN_REPORT and event.value == 0:
-            if None in data:
-                if tries == 0:
-                    time.sleep(1)
-                    tries += 15
-                else:
-                    tries -= 1
-                # This measurement failed to read one of the sensors, try again.
-                data = [None] * 4
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        # per board state, it continues where it was when a board reconnects
+        self.filters = {}
+        self.last_report = {}
+        self.seq = defaultdict(int)
+        self.next_send = defaultdict(float)
+
+    def filter(self, board: int):
+        """Optional low-pass filter of a board, the live stream is decimated from the filtered values."""
+        args = self.settings._args
+        if not args.filter:
+            return None
+        if board not in self.filters:
+            self.filters[board] = LowPassFilter(args.filter, args.filter_order)
+        return self.filters[board]
+
+    def process(self, samples: list) -> list:
+        settings = self.settings
+        out = []
+        for board in sorted(set(board for board, _, _, _ in samples)):
+            if board and settings.protocol != 'binary':
+                # the text protocol has no board id, only the first board is streamed
                 continue
+            batch = [(report, timestamp, data) for b, report, timestamp, data in samples if b == board]
+            rate = settings.output_rate()
+            lowpass = self.filter(board)
+            if lowpass is None:
+                filtered = [data for _, _, data in batch]
+            else:
+                filtered = lowpass.apply([timestamp for _, timestamp, _ in batch], [data for _, _, data in batch],
+                                         rate).tolist()
+            seq, next_send = self.seq, self.next_send
+            for (report, timestamp, _), output in zip(batch, filtered):
+                lost = report - self.last_report.get(board, report - 1) - 1
+                self.last_report[board] = report
+                if not settings.streaming:
+                    continue
+                if lost > 0:
+                    # flag the lost reports with a gap: the output slots they would have filled
+                    seq[board] += int((timestamp - next_send[board]) * rate) if rate else lost
+                if rate and timestamp < next_send[board]:
+                    continue
+                # next slot of the output grid, restart the grid after a pause in the stream
+                next_send[board] = next_send[board] + 1 / rate if rate else 0.0
+                if next_send[board] <= timestamp:
+                    next_send[board] = timestamp + 1 / rate if rate else 0.0
+                out.append((board, seq[board], timestamp, output))
+                seq[board] += 1
+        return out
+
+
+class Telemetry:
+    """Health of the sender, sent in-band every interval seconds so the viewer can relate data problems to load."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.seq = 0
+        self._wall = time.monotonic()
+        self._cpu = time.process_time()
+
+    def due(self) -> bool:
+        return bool(self.interval) and time.monotonic() - self._wall >= self.interval
+
+    def frame(self, reader: MultiBoardReader, link: StreamSink) -> bytes:
+        """Encode a telemetry frame, the CPU load is measured since the previous frame."""
+        wall, cpu = time.monotonic(), time.process_time()
+        load = 100 * (cpu - self._cpu) / (wall - self._wall)
+        self._wall, self._cpu = wall, cpu
+        values = (load, cpu_temperature(), reader.syn_dropped, reader.lost, reader.incomplete, len(link.ring),
+                  link.ring.dropped, link.bytes_written, len(reader.boards))
+        self.seq += 1
+        return encode_frame(FRAME_TELEMETRY, self.seq, time.time(), values)
+
+
+def receive_commands(ser, settings: Settings, responses: queue.Queue):
+    """Read commands from the viewer and queue their responses for the transmit loop."""
+    while ser.is_open:
+        try:
+            line = ser.readline()
+        except Exception as e:
+            print(f"Error while reading commands: {e}")
+            return
+        if not line.strip():
+            continue
+        try:
+            command_id, command, argument = parse_command(line)
+        except ValueError as e:
+            print(e)
+            continue
+        settings.last_command = time.monotonic()
+        try:
+            status, value = settings.handle(command, argument)
+        except (TypeError, ValueError) as e:
+            print(f"Invalid argument for {command}: {e}")
+            status, value = STATUS_ERROR, 0
+        responses.put(encode_frame(FRAME_RESPONSE, command_id, time.time(), (COMMANDS[command], status, value)))
+        # commands that act on the link itself take effect after their response, so it is still sent at the old rate
+        if status == STATUS_OK and command == 'test':
+            responses.put(encode_file(test_pattern(int(value)), time.time()))
+        elif status == STATUS_OK and command == 'baud' and int(value) != settings.baudrate:
+            settings.baud_change = int(value)
+
+
+def receive_hellos(connection: UdpConnection):
+    """Read the datagrams of the viewer without acting on them, so a UDP connection learns where to stream to."""
+    while connection.is_open:
+        try:
+            connection.readline()
+        except OSError as e:
+            if connection.is_open:
+                print(f"Error while reading from the viewer: {e}")
+            return
+
+
+def switch_baudrate(ser, settings: Settings, responses: queue.Queue):
+    """
+    Make a baud rate switch the viewer asked for, and fall back if the viewer does not confirm it in time. A confirmed
+    rate falls back to the initial rate as well once the viewer is gone, when it left without resetting the rate.
+    """
+    if settings.baud_change is not None and responses.empty():
+        # the response was written, wait until it went out at the old rate
+        ser.flush()
+        settings.baud_fallback = (settings.baudrate, time.monotonic() + BAUD_CONFIRM)
+        settings.baudrate = ser.baudrate = settings.baud_change
+        settings.baud_change = None
+        print(f"Switched to {settings.baudrate} baud, waiting for confirmation...")
+    elif settings.baud_fallback is not None and time.monotonic() > settings.baud_fallback[1]:
+        settings.baudrate = ser.baudrate = settings.baud_fallback[0]
+        settings.baud_fallback = None
+        print(f"Baud rate not confirmed, back to {settings.baudrate} baud.")
+    elif settings.baudrate != settings.default_baudrate and time.monotonic() - settings.last_command > LINK_TIMEOUT:
+        settings.baudrate = ser.baudrate = settings.default_baudrate
+        settings.baud_fallback = None
+        print(f"No command from the viewer for {LINK_TIMEOUT:.0f} s, back to {settings.baudrate} baud.")
+
+
+class SenderLink(StreamSink):
+    """
+    The serial link to the viewer: the live stream, and in between the responses to commands, the telemetry and the
+    bulk transfers of recorded trials.
+    """
+
+    def __init__(self, ser, settings: Settings, reader: MultiBoardReader, telemetry: Telemetry,
+                 responses: queue.Queue, capacity: int):
+        super().__init__(ser, lambda *sample: encode_sample(settings.protocol, settings.mode, *sample),
+                         capacity=capacity, min_batch=settings.min_batch, max_batch=settings.max_batch,
+                         process=LiveStream(settings).process)
+        self.settings = settings
+        self.reader = reader
+        self.telemetry = telemetry
+        self.responses = responses
+
+    def finished(self) -> bool:
+        # recorded trials are still transferred after the boards are gone, unless the viewer left
+        return (super().finished() and self.settings.transfers.empty()) or not self.stream.is_open
+
+    def control(self) -> bytes:
+        """Responses and telemetry that are due."""
+        message = b''
+        while not self.responses.empty():
+            message += self.responses.get()
+        # no telemetry piles up while nobody reads the link
+        if self.settings.protocol == 'binary' and not self.unsent and self.telemetry.due():
+            message += self.telemetry.frame(self.reader, self)
+        return message
+
+    def write(self, samples: list):
+        self.send(self.control() + self.message(samples))
+        self.adapt()
+
+    def idle(self):
+        self.max_batch = self.settings.max_batch
+        self.send(self.control())
+        switch_baudrate(self.stream, self.settings, self.responses)
+        if not self.settings.transfers.empty() and not self.unsent:
+            recording = self.settings.transfers.get()
+            with open(recording.path, 'rb') as f:
+                data = f.read()
+            print(f"Transferring {recording.path} ({len(data)} bytes)...")
+            if self.write_drained(encode_file(data, recording.start_time)):
+                print("Transfer done.")
             else:
-                # calculate x and y cop coordinates in mm
-                x_cop = width/2 * (data[1] + data[2] - data[0] - data[3]) / sum(data)
-                y_cop = length/2 * (data[0] + data[1] - data[2] - data[3]) / sum(data)
-                return [x_cop, y_cop]
-        else:
-            print(f"ERROR: Got unexpected event: {evdev.categorize(event)}")
+                # the rest of the broken transfer is not sent, the viewer rejects it by its checksum
+                self.unsent = b''
+                print("The viewer stopped reading, the recording is transferred again once it reads again.")
+                self.settings.transfers.put(recording)
+
+    def write_drained(self, data: bytes, chunk: int = HIGH_WATER) -> bool:
+        """
+        Write a large block in chunks, waiting for the link to drain in between. Returns False if the link stopped
+        taking data.
+        """
+        for i in range(0, len(data), chunk):
+            if not self.drain():
+                return False
+            self.send(data[i:i + chunk])
+        return True
+
+
+def serve(ser, settings: Settings, reader: MultiBoardReader, capacity: int, telemetry: float) -> SenderLink:
+    """Stream to the viewer on a serial port or network connection, until the link fails or the boards are gone."""
+    responses = queue.Queue()
+    link = settings.link = SenderLink(ser, settings, reader, Telemetry(telemetry), responses, capacity)
+    settings.engine.add(link, start=False)
+    commands = None
+    if settings.protocol == 'binary':
+        commands = Thread(target=receive_commands, args=(ser, settings, responses))
+    elif isinstance(ser, UdpConnection):
+        # the text protocol has no commands, but the viewer's hello still tells a UDP connection where to stream to
+        commands = Thread(target=receive_hellos, args=(ser,))
+    if commands is not None:
+        commands.daemon = True
+        commands.start()
+    # the link runs in the calling thread
+    link.run()
+    settings.engine.remove(link)
+    settings.link = None
+    return link
+
+
+def link_report(link) -> str:
+    if link is None:
+        return "no viewer connected"
+    return f"batch size {link.batch}, buffered {len(link.ring)}, discarded {link.ring.dropped}"
 
 
 if __name__ == "__main__":
-    print("Waiting for board...")
-    boardfound = None
-    while not boardfound:
-        boardfound = get_board_device()
-        if boardfound:
-            print("Board found!")
-            break
-        time.sleep(1)
-    print("Opening serial port...")
-    with Serial('/dev/ttyGS0', 9600, timeout=1) as ser:
-        print(f"Serial port {ser.name} opened.")
-        while True:
-            try:
-                data = get_raw_measurement(boardfound)
-            except Exception as e:
-                print("Exception, closing serial port...")
-                break
-            data = [round(i, 4) for i in data]
-            ser.reset_output_buffer()
-            ser.write(f"{str(data)}\n".encode())
-            time.sleep(0.01)
-
-    print(f"Serial port {ser.name} closed.")
-    print("Exiting...")
+    parser = argparse.ArgumentParser(description="Stream center of pressure data from the balance board.")
+    parser.add_argument('--protocol', choices=('binary', 'text'), default='binary',
+                        help="wire protocol, use text for viewers older than the binary protocol")
+    parser.add_argument('--transport', choices=('serial', 'tcp', 'udp'), default='serial',
+                        help="serve the viewer on the USB gadget serial port, or over the network")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="network port for --transport tcp or udp")
+    parser.add_argument('--baudrate', type=int, default=9600,
+                        help="initial baud rate of the serial link, the viewer can negotiate a higher rate")
+    parser.add_argument('--mode', choices=('cop', 'raw'), default='cop',
+                        help="send the center of pressure, or the raw sensor values to compute it in the viewer")
+    parser.add_argument('--cpu-report', type=float, default=0, metavar='SECONDS',
+                        help="print the CPU usage per delivered sample every SECONDS seconds")
+    parser.add_argument('--buffer', type=int, default=1000, metavar='SAMPLES',
+                        help="capacity of the ring buffer, the oldest samples are discarded when it overflows")
+    parser.add_argument('--min-batch', type=int, default=1, help="smallest number of samples per write")
+    parser.add_argument('--max-batch', type=int, default=64, help="largest number of samples per write")
+    parser.add_argument('--record', type=float, default=0, metavar='SECONDS',
+                        help="record a trial of SECONDS seconds on the Pi and transfer it to the viewer afterwards")
+    parser.add_argument('--record-dir', default=os.path.expanduser('~/recordings'),
+                        help="directory for recordings made on the Pi")
+    parser.add_argument('--live-rate', type=float, default=20, metavar='HZ',
+                        help="rate of the live stream while a trial is recorded, 0 for the full rate")
+    parser.add_argument('--calibration', default=DEFAULT_PATH,
+                        help="calibration file with the sensor offsets and gains, see accuracytest.py")
+    parser.add_argument('--tare', type=int, default=0, metavar='SAMPLES',
+                        help="tare over the first SAMPLES samples after startup, keep the board unloaded")
+    parser.add_argument('--telemetry', type=float, default=1, metavar='SECONDS',
+                        help="send the health of the sender every SECONDS seconds, 0 to disable")
+    parser.add_argument('--rate', type=float, default=0, metavar='HZ',
+                        help="output rate of the stream, 0 for the board's native rate")
+    parser.add_argument('--filter', type=float, default=0, metavar='HZ',
+                        help="low-pass filter the stream with this cutoff before it is decimated to the output rate, "
+                             "the cutoff is lowered to below the Nyquist frequency of the output rate")
+    parser.add_argument('--filter-order', type=int, default=4, help="order of the Butterworth low-pass filter, even")
+    parser.add_argument('--boards', type=int, default=1,
+                        help="number of boards to wait for at startup, boards that connect later are streamed as well")
+    args = parser.parse_args()
+    if args.record and args.protocol != 'binary':
+        parser.error("--record needs the binary protocol to transfer the recording")
+    if args.mode == 'raw' and args.protocol != 'binary':
+        parser.error("--mode raw needs the binary protocol")
+    if args.filter and (args.filter_order < 2 or args.filter_order % 2):
+        parser.error("--filter-order must be an even number of at least 2")
+    if args.boards > 1 and args.protocol != 'binary':
+        parser.error("--boards needs the binary protocol to tell the boards apart")
+
+    print(f"Waiting for {args.boards} board(s)...")
+    watcher = BoardWatcher()
+    devices = watcher.wait(args.boards)
+    print(f"{len(devices)} board(s) found!")
+    # the reader attaches boards that appear later, and boards that come back after a Bluetooth drop
+    reader = MultiBoardReader(devices, watcher)
+    transfers = queue.Queue()
+    settings = Settings(args, transfers, len(devices))
+    engine = AcquisitionEngine(reader, settings.calibration)
+    settings.engine = engine
 
+    if args.cpu_report:
+        engine.add(StatsSink(args.cpu_report, reader, lambda: link_report(settings.link)))
+    if args.record:
+        try:
+            settings.record(args.record)
+        except ValueError as e:
+            parser.error(f"--record: {e}")
+    engine.start()
+
+    if args.transport == 'serial':
+        print("Opening serial port...")
+        with Serial('/dev/ttyGS0', args.baudrate, timeout=1, write_timeout=1) as ser:
+            print(f"Serial port {ser.name} opened at {args.baudrate} baud, protocol: {args.protocol}, "
+                  f"mode: {args.mode}.")
+            link = serve(ser, settings, reader, args.buffer, args.telemetry)
+        print(f"Serial port {ser.name} closed.")
+    elif args.transport == 'udp':
+        with UdpConnection(args.port) as connection:
+            link = serve(connection, settings, reader, args.buffer, args.telemetry)
+    else:
+        with TcpServer(args.port) as server:
+            link = None
+            # one viewer at a time, the next viewer can connect when it leaves
+            while engine.is_alive():
+                connection = server.accept()
+                if connection is None:
+                    continue
+                print(f"Viewer connected from {connection.name}, protocol: {args.protocol}, mode: {args.mode}.")
+                with connection:
+                    link = serve(connection, settings, reader, args.buffer, args.telemetry)
+                print(f"Viewer {connection.name} disconnected.")
+
+    if link is not None:
+        print(f"{link.ring.pushed} samples acquired, {link.ring.dropped} discarded.")
+    if reader.reconnects:
+        mean = sum(reader.reconnects) / len(reader.reconnects)
+        print(f"{len(reader.reconnects)} board reconnects, mean {mean:.2f} s, longest {max(reader.reconnects):.2f} s.")
+    print("Exiting...")
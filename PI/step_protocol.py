@@ -0,0 +1,380 @@
+"""
+Wire protocol between the STEP Pi sender and the STEP viewer.
+
+Two modes are supported:
+* text: every sample is sent as ``str([x, y, t])`` followed by a newline, where t is the board timestamp. This is
+  the original protocol, readers that only expect ``[x, y]`` ignore the timestamp.
+* binary: every sample is sent as a fixed size frame:
+
+    offset  size  field
+    0       2     sync bytes (0xA5 0x5A)
+    2       1     frame type
+    3       1     board id (index of the board on the sender, 0 with a single board)
+    4       4     sequence number (uint32)
+    8       8     board timestamp in seconds (float64)
+    16      n     payload (n depends on the frame type, see PAYLOAD_FIELDS)
+    16+n    2     CRC-16/CCITT-FALSE over all preceding bytes of the frame
+
+The board id lets one sender stream several boards over the same link, sequence numbers count per board.
+
+A FRAME_FILE frame announces a bulk transfer: it is directly followed by `size` bytes of file data, which are checked
+against the CRC-32 in the frame. A transfer is at most MAX_FILE_SIZE bytes.
+
+The viewer controls the sender with text commands, one per line: ``<id> <command> [argument]``. The sender answers
+every command with a FRAME_RESPONSE frame that carries the command id as its sequence number.
+
+The sender interleaves FRAME_TELEMETRY frames with the data at a fixed interval, to monitor the Pi under load.
+
+All fields are little-endian. The decoders use NumPy to decode a whole buffer of frames at once.
+"""
+import struct
+import time
+import zlib
+from binascii import crc_hqx
+from itertools import compress
+
+import numpy as np
+
+SYNC = b'\xa5\x5a'
+HEADER_SIZE = 16
+CRC_SIZE = 2
+# largest bulk transfer, a recording on the Pi is refused if its file could be larger; a larger size announced by a
+# FRAME_FILE frame is taken as corrupt, so the decoder does not buffer the stream while it waits for the data
+MAX_FILE_SIZE = 64 << 20
+
+# frame types
+FRAME_COP = 0x01
+FRAME_RAW = 0x02
+FRAME_FILE = 0x10
+FRAME_RESPONSE = 0x20
+FRAME_TELEMETRY = 0x30
+
+# name and struct format of every payload field per frame type
+PAYLOAD_FIELDS = {
+    FRAME_COP: (('x', 'f'), ('y', 'f')),
+    # sensor values top left, top right, bottom left, bottom right
+    FRAME_RAW: (('tl', 'f'), ('tr', 'f'), ('bl', 'f'), ('br', 'f')),
+    FRAME_FILE: (('size', 'I'), ('crc32', 'I')),
+    FRAME_RESPONSE: (('command', 'B'), ('status', 'B'), ('value', 'd')),
+    # health of the sender: CPU load in % of one core, SoC temperature in degrees Celsius (NaN if unknown), kernel
+    # event buffer overruns (SYN_DROPPED), sensor reports lost in overruns and disconnects, incomplete sensor reports,
+    # samples in the ring buffer, samples discarded by the ring buffer, bytes written to the link and connected boards
+    FRAME_TELEMETRY: (('cpu', 'f'), ('temperature', 'f'), ('syn_dropped', 'I'), ('lost', 'I'), ('incomplete', 'I'),
+                      ('buffered', 'I'), ('discarded', 'I'), ('bytes_written', 'Q'), ('boards', 'B')),
+}
+
+# commands from the viewer to the sender, with the code used in their response
+COMMANDS = {
+    'start': 1,  # start streaming
+    'stop': 2,  # stop streaming
+    'rate': 3,  # output rate in Hz, 0 for the board's native rate
+    'batch': 4,  # largest number of samples per write
+    'mode': 5,  # 'cop' or 'raw'
+    'tare': 6,  # zero the sensors with the current load
+    'ping': 7,  # answered immediately, to measure the round trip time
+    'record': 8,  # record a trial of the given number of seconds on the Pi
+    'baud': 9,  # switch the link to the given baud rate, repeat it at the new rate to keep it
+    'test': 10,  # send the given number of bytes of test_pattern() as a bulk transfer, to test the link
+}
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+_PAYLOAD = {frame_type: struct.Struct('<' + ''.join(f for _, f in fields))
+            for frame_type, fields in PAYLOAD_FIELDS.items()}
+
+FRAME_SIZE = {frame_type: HEADER_SIZE + payload.size + CRC_SIZE for frame_type, payload in _PAYLOAD.items()}
+
+_HEADER = struct.Struct('<2sBBId')
+
+
+def encode_frame(frame_type: int, seq: int, timestamp: float, values, board: int = 0) -> bytes:
+    """Encode one binary frame."""
+    body = _HEADER.pack(SYNC, frame_type, board, seq & 0xFFFFFFFF, timestamp) + _PAYLOAD[frame_type].pack(*values)
+    return body + struct.pack('<H', crc_hqx(body, 0xFFFF))
+
+
+def encode_file(data: bytes, timestamp: float = 0.0) -> bytes:
+    """Encode a bulk transfer: a FRAME_FILE frame followed by the data itself."""
+    return encode_frame(FRAME_FILE, 0, timestamp, (len(data), zlib.crc32(data))) + data
+
+
+def encode_command(command_id: int, command: str, argument=None) -> bytes:
+    """Encode one command line for the sender."""
+    if command not in COMMANDS:
+        raise ValueError(f"Unknown command: {command}")
+    line = f"{command_id} {command}" if argument is None else f"{command_id} {command} {argument}"
+    return f"{line}\n".encode()
+
+
+def parse_command(line: bytes):
+    """Parse a command line, returns (command id, command, argument or None). Raises ValueError when malformed."""
+    parts = line.decode('ascii').split()
+    if len(parts) not in (2, 3) or parts[1] not in COMMANDS:
+        raise ValueError(f"Malformed command: {line!r}")
+    return int(parts[0]), parts[1], parts[2] if len(parts) == 3 else None
+
+
+def test_pattern(size: int) -> bytes:
+    """Data of a link test: every byte value in turn, so a corrupted or dropped byte shows up in the comparison."""
+    return (bytes(range(256)) * (size // 256 + 1))[:size]
+
+
+def encode_text(values) -> bytes:
+    """Encode one sample in the original text format."""
+    return f"{str(list(values))}\n".encode()
+
+
+def frame_dtype(frame_type: int):
+    """Return the NumPy structured dtype matching one frame of the given type."""
+    fields = [('sync', '<u2'), ('type', 'u1'), ('board', 'u1'), ('seq', '<u4'), ('time', '<f8')]
+    fields += [(name, '<' + f) for name, f in PAYLOAD_FIELDS[frame_type]]
+    fields += [('crc', '<u2')]
+    return np.dtype(fields)
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_CRC_TABLE = _crc_table()
+_SYNC_WORD = struct.unpack('<H', SYNC)[0]
+# characters of the text protocol, and the brackets and commas that separate its numbers
+_NEWLINE, _RETURN, _COMMA, _OPEN, _CLOSE = b'\n\r,[]'
+_SEPARATORS = bytes.maketrans(b'[],', b'   ')
+# bytes that end a number of the text protocol: the separators and the whitespace bytes.split() splits on
+_BREAKS = np.zeros(256, dtype=bool)
+_BREAKS[list(b'[], \t\n\r\x0b\x0c')] = True
+
+
+def crc16_rows(rows):
+    """
+    CRC-16/CCITT-FALSE of every row of a 2D uint8 array.
+    The loop runs over the columns (bytes in a frame), so all frames in the buffer are processed at once.
+    """
+    table = np.asarray(_CRC_TABLE, dtype=np.uint16)
+    crc = np.full(rows.shape[0], 0xFFFF, dtype=np.uint16)
+    for col in range(rows.shape[1]):
+        crc = (crc << np.uint16(8)) ^ table[(crc >> np.uint16(8)) ^ rows[:, col]]
+    return crc
+
+
+class FrameDecoder:
+    """
+    Incremental decoder for the binary protocol.
+    Feed it whatever was read from the port; it returns the complete frames as structured NumPy arrays
+    and keeps incomplete bytes for the next call. A bulk transfer is returned as (FRAME_FILE, data), where data is
+    None if the transfer failed its integrity check; its data is then decoded as frames again, since a transfer that
+    broke off is followed by the rest of the stream.
+    """
+    mode = 'binary'
+
+    def __init__(self):
+        self._pending = b''
+        self._dtypes = {frame_type: frame_dtype(frame_type) for frame_type in PAYLOAD_FIELDS}
+        self._file = None  # header of the bulk transfer in progress
+        self._blob = bytearray()
+        self.frames = 0
+        self.crc_errors = 0
+        self.skipped_bytes = 0
+        self.file_errors = 0
+
+    def feed(self, data: bytes):
+        """Decode data, returns a list of (frame type, frames) tuples in the order they were received."""
+        buf = self._pending + bytes(data)
+        pos = 0
+        out = []
+        while True:
+            if self._file is not None:
+                chunk = buf[pos:pos + int(self._file['size']) - len(self._blob)]
+                self._blob += chunk
+                pos += len(chunk)
+                if len(self._blob) < self._file['size']:
+                    break
+                data = bytes(self._blob)
+                valid = zlib.crc32(data) == self._file['crc32']
+                self._file = None
+                self._blob = bytearray()
+                if not valid:
+                    self.file_errors += 1
+                    out.append((FRAME_FILE, None))
+                    buf, pos = data + buf[pos:], 0
+                    continue
+                out.append((FRAME_FILE, data))
+            if len(buf) - pos < HEADER_SIZE:
+                break
+            if buf[pos:pos + 2] != SYNC:
+                nxt = buf.find(SYNC, pos + 1)
+                if nxt < 0:
+                    # keep a trailing half sync byte
+                    nxt = len(buf) - 1 if buf[-1] == SYNC[0] else len(buf)
+                self.skipped_bytes += nxt - pos
+                pos = nxt
+                continue
+
+            frame_type = buf[pos + 2]
+            size = FRAME_SIZE.get(frame_type)
+            if size is None:
+                self.skipped_bytes += 1
+                pos += 1
+                continue
+            count = (len(buf) - pos) // size
+            if count == 0:
+                break
+
+            # view all following frames as frames of this type, then keep the leading run that is aligned
+            frames = np.frombuffer(buf, dtype=self._dtypes[frame_type], count=count, offset=pos)
+            aligned = (frames['sync'] == _SYNC_WORD) & (frames['type'] == frame_type)
+            run = count if aligned.all() else int(np.argmin(aligned))
+            frames = frames[:run]
+            rows = np.frombuffer(buf, dtype=np.uint8, count=run * size, offset=pos).reshape(run, size)
+            valid = crc16_rows(rows[:, :-CRC_SIZE]) == frames['crc']
+            if valid.all():
+                good = run
+            else:
+                # stop at the first corrupt frame and resynchronise right after its sync bytes
+                good = int(np.argmin(valid))
+                self.crc_errors += 1
+            if frame_type == FRAME_FILE and good and frames[0]['size'] > MAX_FILE_SIZE:
+                # a size no sender announces, resynchronise right after the sync bytes instead of waiting for the data
+                self.file_errors += 1
+                out.append((FRAME_FILE, None))
+                self.skipped_bytes += 1
+                pos += 1
+                continue
+            if frame_type == FRAME_FILE and good:
+                # the file data follows directly after the header, it is returned once it is complete
+                self._file = frames[0]
+                self.frames += 1
+                pos += size
+                continue
+            if good:
+                out.append((frame_type, frames[:good]))
+                self.frames += good
+            pos += good * size
+            if good < run:
+                self.skipped_bytes += 1
+                pos += 1
+
+        self._pending = buf[pos:]
+        return out
+
+
+class TextDecoder:
+    """
+    Decoder for the original text protocol. Returns the same structured arrays as FrameDecoder, sequence numbers are
+    counted locally and the time is NaN for senders that do not send the board timestamp.
+
+    All complete lines of a read are parsed at once: the lines and the count of numbers on every line are checked with
+    NumPy, and the numbers of all lines with the same number of fields are converted in one pass. A partial line is
+    kept for the next call, a line that cannot be parsed is counted in parse_errors and skipped.
+    """
+    mode = 'text'
+
+    def __init__(self):
+        self._pending = b''
+        self._dtype = frame_dtype(FRAME_COP)
+        self._seq = 0
+        self.frames = 0
+        self.parse_errors = 0
+
+    def feed(self, data: bytes):
+        buf = self._pending + bytes(data)
+        end = buf.rfind(b'\n') + 1
+        self._pending = buf[end:]
+        if not end:
+            return []
+        samples = self.parse(buf[:end])
+        if not len(samples):
+            return []
+        frames = np.zeros(len(samples), dtype=self._dtype)
+        frames['seq'] = np.arange(self._seq, self._seq + len(samples))
+        frames['type'] = FRAME_COP
+        frames['x'], frames['y'], frames['time'] = samples.T
+        self._seq += len(samples)
+        self.frames += len(samples)
+        return [(FRAME_COP, frames)]
+
+    def parse(self, data: bytes):
+        """Parse complete lines ``[x, y]`` or ``[x, y, t]``, returns the valid samples as an (n, 3) array."""
+        chars = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(chars == _NEWLINE)
+        starts = np.concatenate(([0], ends[:-1] + 1))
+        last = ends - 1 - (chars[ends - 1] == _RETURN)
+        commas = np.bincount(np.searchsorted(ends, np.flatnonzero(chars == _COMMA)), minlength=len(ends))
+        # a number starts where a byte that is not a break follows a break, a valid line starts with a bracket so no
+        # number starts at the first byte; every line has one more number than commas
+        breaks = _BREAKS[chars]
+        numbers = np.bincount(np.searchsorted(ends, np.flatnonzero(breaks[:-1] > breaks[1:]) + 1), minlength=len(ends))
+        valid = (last > starts) & (chars[starts] == _OPEN) & (chars[last] == _CLOSE) & (commas >= 1) & (commas <= 2) \
+            & (numbers == commas + 1)
+        samples = np.full((len(ends), 3), np.nan)
+        lines = data.split(b'\n')
+        for fields in (2, 3):
+            rows = valid & (commas == fields - 1)
+            if not rows.any():
+                continue
+            try:
+                numbers = b' '.join(compress(lines, rows)).translate(_SEPARATORS).split()
+                samples[rows, :fields] = np.fromiter(map(float, numbers), np.float64, len(numbers)).reshape(-1, fields)
+            except ValueError:
+                # a field that is not a number, find its line
+                for row in np.flatnonzero(rows):
+                    try:
+                        samples[row, :fields] = [float(i) for i in lines[row].strip()[1:-1].split(b',')]
+                    except ValueError:
+                        valid[row] = False
+        self.parse_errors += int(len(valid) - np.count_nonzero(valid))
+        return samples[valid]
+
+
+def detect_protocol(data: bytes):
+    """Guess the protocol from the first bytes received after connecting, returns None if undecided."""
+    if SYNC in data:
+        return 'binary'
+    if b'\n' in data and data.split(b'\n')[-2].strip().startswith(b'['):
+        return 'text'
+    return None
+
+
+def get_decoder(mode: str):
+    """Return a decoder for 'binary' or 'text' mode."""
+    if mode == 'binary':
+        return FrameDecoder()
+    elif mode == 'text':
+        return TextDecoder()
+    raise ValueError(f"Unknown protocol: {mode}")
+
+
+def benchmark(mode: str, samples: int = 100000, chunk: int = 4096) -> float:
+    """Decode samples encoded in the given mode in reads of chunk bytes, returns the throughput in samples/s."""
+    rng = np.random.default_rng(0)
+    cop = rng.uniform(-200, 200, (samples, 2))
+    if mode == 'binary':
+        data = b''.join(encode_frame(FRAME_COP, i, i / 100, values) for i, values in enumerate(cop.tolist()))
+    else:
+        data = b''.join(encode_text([round(x, 4), round(y, 4), i / 100]) for i, (x, y) in enumerate(cop.tolist()))
+    decoder = get_decoder(mode)
+    start = time.perf_counter()
+    for i in range(0, len(data), chunk):
+        decoder.feed(data[i:i + chunk])
+    elapsed = time.perf_counter() - start
+    if decoder.frames != samples:
+        raise RuntimeError(f"Decoded {decoder.frames} of {samples} samples.")
+    return samples / elapsed
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Measure the throughput of the decoders of the viewer.")
+    parser.add_argument('--samples', type=int, default=100000, help="number of samples to decode")
+    parser.add_argument('--chunk', type=int, default=4096, help="bytes per read, as read from the serial port")
+    args = parser.parse_args()
+    for mode in ('binary', 'text'):
+        print(f"{mode}: {benchmark(mode, args.samples, args.chunk):,.0f} samples/s")
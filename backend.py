@@ -1,22 +1,36 @@
 import sys
-import time
+import asyncio
 
-from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QTableWidgetItem
+from PySide6.QtWidgets import QApplication, QMainWindow, QFileDialog, QTableWidgetItem, QPushButton, QMenu
 from PySide6.QtCore import Qt, QTimer
 from PySide6.QtGui import QShortcut
-from threading import Thread
-import serial
-from serial.tools import list_ports
+from threading import Lock
 import datetime
-from time import sleep
 import numpy as np
 from pyentrp import entropy as ent
 # Custom imports
 import frontend
+from widgets import Diagnostics
+from PI.step_protocol import FRAME_RAW
+from PI.step_file import read_recording
+from ports import PortWatcher
+from engine import IngestEngine
+from source import Source
+from ingest import RAW_FIELDS, BOARD_WIDTH, BOARD_LENGTH, LIVE_FIELDS, LiveBuffer, BatchQueue, \
+    RecordingBuffer, MAX_GAP, raw_values, cop_from_raw, board_column, combine_boards, prepare_recording
 from code_descriptors_postural_control.descriptors import compute_all_features
 from code_descriptors_postural_control.stabilogram.stato import Stabilogram
 
 
+# seconds of data in the live plots, and the highest sample rate their buffers are sized for
+LIVE_WINDOW = 5.0
+LIVE_MAX_RATE = 1000
+# seconds a recording waits beyond its length for the last samples before it stops anyway
+RECORD_TIMEOUT = 2.0
+# colour of the status light of a source
+STATUS_COLORS = {'display': 'green', 'connected': 'orange', 'disconnected': 'red'}
+
+
 class STEPviewer:
 
     def __init__(self, dummy=False):
@@ -38,7 +52,18 @@ class STEPviewer:
                 "practitioner": config['GENERAL']['practitioner'],
                 "url": config['RESEARCHDRIVE']['url'],
                 "username": config['RESEARCHDRIVE']['username'],
-                "password": config['RESEARCHDRIVE']['password']
+                "password": config['RESEARCHDRIVE']['password'],
+                "protocol": config.get('SERIAL', 'protocol', fallback='auto'),
+                "idle_rate": config.getfloat('SERIAL', 'idle_rate', fallback=25),
+                "baudrate": config.getint('SERIAL', 'baudrate', fallback=9600),
+                "negotiate": [int(i) for i in config.get('SERIAL', 'negotiate', fallback='').replace(',', ' ').split()],
+                "sources": config.get('NETWORK', 'sources', fallback='').replace(',', ' ').split(),
+                "width": config.getfloat('BOARD', 'width', fallback=BOARD_WIDTH),
+                "length": config.getfloat('BOARD', 'length', fallback=BOARD_LENGTH),
+                "window": config.getfloat('LIVE', 'window', fallback=LIVE_WINDOW),
+                "max_rate": config.getfloat('LIVE', 'max_rate', fallback=LIVE_MAX_RATE),
+                "max_gap": config.getfloat('ANALYSIS', 'max_gap', fallback=MAX_GAP),
+                "interpolation": config.get('ANALYSIS', 'interpolation', fallback='linear')
             }
         except Exception as e:
             print(f"Error while reading config file: {e}")
@@ -46,28 +71,45 @@ class STEPviewer:
                 "practitioner": "unknown",
                 "url": None,
                 "username": None,
-                "password": None
+                "password": None,
+                "protocol": 'auto',
+                "idle_rate": 25,
+                "baudrate": 9600,
+                "negotiate": [],
+                "sources": [],
+                "width": BOARD_WIDTH,
+                "length": BOARD_LENGTH,
+                "window": LIVE_WINDOW,
+                "max_rate": LIVE_MAX_RATE,
+                "max_gap": MAX_GAP,
+                "interpolation": 'linear'
             }
 
         self.ui.modes.currentChanged.connect(self.switchmode)
         self.mode = self.ui.modes.currentIndex()
 
-        self.livex = []
-        self.livey = []
+        # live data per channel, a board of one of the sources, in ring buffers sized for the live window at the
+        # highest expected rate
+        self.live = {}
+        # (source, channel, samples) batches of the ingest tasks, moved into the live buffers by the GUI every frame
+        self.livequeue = BatchQueue()
         self.analysisdata = np.array([])
 
         self.idx = 0
 
-        self.display = False
-
         # Live mode variables
-        self.status = 'disconnected'
         #self.ui.statustext.setText(f"initializing...")
 
         self.com_list = []
-        self.com_port_selected = None
+        self.com_port_selected = None  # source of the com port dropdown, set from the GUI thread
+        # every source that is read, by name: the selected one and the ones added next to it
+        self.sources = {}
+        self.sourcelights = {}  # status lights of the added sources, by name
+        self.channel_lock = Lock()
 
         self.recording = []
+        self.recordingcolumns = ['time', 'x', 'y']
+        self.recordingtelemetry = []  # telemetry of the Pi senders during the recording
         self.recordinginfo = {
             "date": "",
             "time": "",
@@ -84,6 +126,7 @@ class STEPviewer:
             "notes": ""
         }
         self.recordstate = False
+        self.recordbuffer = None  # RecordingBuffer the ingest tasks append to while recording
 
         if dummy:
             dummypath = 'testrecordings/STEP_dummyrecording.xlsx'
@@ -92,8 +135,10 @@ class STEPviewer:
             except Exception as e:
                 print(f"Error while opening file: {e}")
                 return
-            self.livex = [i[1] for i in self.recording]
-            self.livey = [i[2] for i in self.recording]
+            samples = np.full((len(LIVE_FIELDS), len(self.recording)), np.nan)
+            samples[:3] = self.recording[:, :3].T
+            self.live = {0: self.newlivebuffer()}
+            self.live[0].extend(samples)
 
         # Analysis mode variables
         self.analysisidx = 0  # index of current measurement
@@ -101,6 +146,16 @@ class STEPviewer:
         self.variables = None  # dictionary of variables
 
         # Live mode setup
+        # the ingest of every source, the recordings and the uploads run as tasks on the event loop of the engine
+        self.engine = IngestEngine()
+        self.engine.start()
+        # stop streaming before the application exits
+        self.app.aboutToQuit.connect(self.engine.stop)
+        # Serial ports, listed in the background and published to the combo box in the GUI thread
+        self.ui.comport.currentTextChanged.connect(self.selectcom)
+        self.portwatcher = PortWatcher(self.config['sources'])
+        self.portwatcher.changed.connect(self.update_com)
+        self.portwatcher.start()
         # Toolbar: from left to right
         self.ui.startrecording.clicked.connect(self.recorder)
 
@@ -111,9 +166,28 @@ class STEPviewer:
         # Patient info
         self.ui.identifierreload.clicked.connect(self.randompatient)
 
+        # Add button, reads another source at the same time, with its status light next to the button
+        self.addbutton = QPushButton("+", self.ui.livetab)
+        self.addbutton.setFixedWidth(30)
+        self.addbutton.setToolTip("Record from another source at the same time")
+        self.addbutton.setMenu(QMenu(self.addbutton))
+        self.addbutton.menu().aboutToShow.connect(self.fillsourcemenu)
+        self.ui.horizontalLayout.insertWidget(2, self.addbutton)
+
+        # Tare button, zeroes the boards through the control channels of the Pi senders
+        self.tarebutton = QPushButton("Tare", self.ui.livetab)
+        self.tarebutton.clicked.connect(self.tare)
+        self.ui.horizontalLayout.insertWidget(3, self.tarebutton)
+
+        # Diagnostics panel with the telemetry of the Pi sender
+        self.diagnostics = Diagnostics(self.ui.livetab)
+        self.ui.livedisplayright.insertWidget(1, self.diagnostics)
+
         # Plots
         self.ui.liveapwidget.setmode('AP', live=True)
         self.ui.livemlwidget.setmode('ML', live=True)
+        self.ui.liveapwidget.graph.setXRange(0, self.config['window'])
+        self.ui.livemlwidget.graph.setXRange(0, self.config['window'])
 
         # Analysis mode setup
         # shortcuts
@@ -157,95 +231,178 @@ class STEPviewer:
         self.timer.timeout.connect(self.update)
         self.timer.start(self.interval)  # Start the timer
 
-        # threading
-        self.readthread = Thread(target=self.read_from_serial)
-        self.readthread.daemon = True  # Daemon threads are terminated when the main program exits.
-        self.readthread.start()
-
         # start application
         self.win.show()
         print("GUI initialized.")
         self.app.exec()
 
-    def update_com(self):
+    def update_com(self, ports):
         """
-        Method that gets the list of available coms in the system
+        Slot of the port watcher: fill the com port dropdown with the serial ports and the network sources of the
+        config, keeping the selected port when it is still there
         """
-        # update com list
-        ports = list_ports.comports()
-        # exclude bluetooth serial ports
-        ports = set([port for port in ports if 'Bluetooth' not in port[1]])
-        if len(ports) == 0:
-            self.com_list = {'No com ports found'}
-        else:
-            self.com_list = set([com[0] for com in ports])
-
-        # update com port dropdown
-        # get current com ports
-        current_coms = set([self.ui.comport.itemText(i) for i in range(self.ui.comport.count())])
-        if current_coms != self.com_list:
-            self.ui.comport.clear()
-            self.ui.comport.addItems(self.com_list)
-
-    def read_from_serial(self):
-        while True:
-            if self.mode == 0:
-                self.display = False
-                self.update_com()
-                if self.com_port_selected != self.ui.comport.currentText() and self.ui.comport.currentText() in self.com_list:
-                    self.com_port_selected = self.ui.comport.currentText()
-                    print(f'com port selected: {self.com_port_selected}')
-                if self.com_port_selected is not None and self.com_port_selected != 'No com ports found':
-                    try:
-                        print(f"Opening serial port {self.com_port_selected}...")
-                        with serial.Serial(self.com_port_selected, 9600, timeout=1) as ser:
-                            print(f"Serial port {ser.name} successfully opened.")
-                            self.status = 'connected'
-                            line = ''
-                            while self.com_port_selected == self.ui.comport.currentText() and self.mode == 0:
-                                incoming = ser.readline().decode()
-                                if incoming and incoming != '':
-                                    self.status = 'display'
-                                    line += incoming[1:-2]
-                                    self.livex.append(float(line.split(', ')[0]))
-                                    self.livey.append(float(line.split(', ')[1]))
-                                    line = ''
-                                    if len(self.livex) > 50:
-                                        self.livex.pop(0)
-                                        self.livey.pop(0)
-                                else:
-                                    self.display = 'connected'
-                                    time.sleep(0.01)
-                                    continue
-
-                    except serial.SerialException as e:
-                        print(f"An error occurred: {e} \n Trying to reconnect...")
-                        self.status = 'disconnected'
-                        self.display = False
-                        sleep(1)
-                else:
-                    sleep(1)
-            else:
-                sleep(1)
+        self.com_list = ports
+        selected = self.ui.comport.currentText()
+        self.ui.comport.blockSignals(True)
+        self.ui.comport.clear()
+        self.ui.comport.addItems(ports or ['No com ports found'])
+        if selected in ports:
+            self.ui.comport.setCurrentText(selected)
+        self.ui.comport.blockSignals(False)
+        self.selectcom(self.ui.comport.currentText())
+
+    def selectcom(self, port):
+        """Read the selected port instead of the previous one, in its own ingest task."""
+        port = port if port in self.com_list else None
+        if port != self.com_port_selected:
+            if self.com_port_selected is not None:
+                self.removesource(self.com_port_selected)
+            self.com_port_selected = port
+            print(f'com port selected: {port}')
+            if port is not None:
+                # a source that was added next to the previous one becomes the selected one
+                self.removesource(port)
+                self.addsource(port)
+
+    def addsource(self, name):
+        """Start reading a source, its ingest task runs next to the tasks of the other sources."""
+        source = Source(name, self)
+        self.sources[name] = source
+        self.engine.submit(source.run(), f"Ingest of {name}")
+        return source
+
+    def removesource(self, name):
+        """Stop reading a source and clear the lines of its boards."""
+        source = self.sources.pop(name, None)
+        if source is None:
+            return
+        source.close()
+        light = self.sourcelights.pop(name, None)
+        if light is not None:
+            self.ui.horizontalLayout.removeWidget(light)
+            light.deleteLater()
+        # the ingest task of the source may still add a channel until it stopped
+        with self.channel_lock:
+            channels = list(source.channels.values())
+        for channel in channels:
+            self.live.pop(channel, None)
+            for widget in (self.ui.livestabilogramwidget, self.ui.liveapwidget, self.ui.livemlwidget):
+                widget.boardline(channel).setData([], [])
+
+    def fillsourcemenu(self):
+        """List the ports that are not read yet in the menu of the add button."""
+        menu = self.addbutton.menu()
+        menu.clear()
+        for port in self.com_list:
+            if port not in self.sources:
+                menu.addAction(port, lambda port=port: self.addextrasource(port))
+        if menu.isEmpty():
+            menu.addAction("No other sources found").setEnabled(False)
+
+    def addextrasource(self, name):
+        """Read a source next to the selected one, with its own status light that removes it when clicked."""
+        if name in self.sources:
+            return
+        print(f'source added: {name}')
+        self.addsource(name)
+        light = QPushButton(self.ui.livetab)
+        light.setFixedSize(20, 20)
+        light.clicked.connect(lambda: self.removesource(name))
+        self.sourcelights[name] = light
+        self.ui.horizontalLayout.insertWidget(self.ui.horizontalLayout.indexOf(self.addbutton), light)
+
+    def sendcommand(self, command, argument=None):
+        """Send a command to the Pi senders of all sources, returns whether any of them has a control channel."""
+        sent = [source.sendcommand(command, argument) for source in list(self.sources.values())]
+        return any(sent)
+
+    def tare(self):
+        if not self.sendcommand('tare'):
+            print("Tare needs a Pi sender using the binary protocol.")
+            return
+        print("Taring, keep the board unloaded...")
+
+    def receiveboard(self, source, board, samples):
+        """
+        Queue the samples of a board of a source for the live plots, and append them to the recording if there is
+        one. Every board of every source gets its own channel, the lowest one that is free.
+        """
+        channel = source.channels.get(board)
+        if channel is None:
+            with self.channel_lock:
+                used = {channel for other in list(self.sources.values()) for channel in other.channels.values()}
+                channel = min(set(range(len(used) + 1)) - used)
+                source.channels[board] = channel
+        self.livequeue.put((source, channel, samples))
+        buffer = self.recordbuffer
+        if buffer is not None:
+            buffer.extend(channel, samples)
+
+    def drainlive(self):
+        """
+        Move the batches the ingest tasks queued since the last frame into the live buffers, one write per channel.
+        Batches of a source that was removed since are dropped.
+        """
+        batches = {}
+        for source, channel, samples in self.livequeue.drain():
+            if not source.closed:
+                batches.setdefault(channel, []).append(samples)
+        for board, samples in batches.items():
+            if board not in self.live:
+                self.live[board] = self.newlivebuffer()
+            self.live[board].extend(samples[0] if len(samples) == 1 else np.hstack(samples))
+
+    def newlivebuffer(self):
+        """
+        Ring buffer for the live window of a board, with a second of margin for the samples that are written before the
+        plots drew their views.
+        """
+        rate = self.config['max_rate']
+        return LiveBuffer(int(self.config['window'] * rate), int(rate))
+
+    def reprocessrecording(self):
+        """Recompute the center of pressure of the boards with raw sensor values, using the configured geometry."""
+        columns = list(self.recordingcolumns)
+        for name in columns:
+            if not name.startswith('x'):
+                continue
+            # the fields of every board share the suffix of its x column
+            suffix = name[1:]
+            fields = [field + suffix for field in RAW_FIELDS]
+            if 'y' + suffix not in columns or not all(field in columns for field in fields):
+                continue
+            raw = self.recording[:, [columns.index(field) for field in fields]].astype(np.float64)
+            if np.isnan(raw).any():
+                continue
+            self.recording = self.recording.astype(np.float64)
+            self.recording[:, columns.index(name)], self.recording[:, columns.index('y' + suffix)], _ = \
+                cop_from_raw(raw, self.config['width'], self.config['length'])
 
     def update(self):
         # Live mode
-        # TODO: add correct time to live plot
         if self.mode == 0:
-            self.ui.livestabilogramwidget.line.setData(self.livex, self.livey)
-            self.ui.liveapwidget.line.setData(np.linspace(0, 30, len(self.livey)), self.livey)
-            self.ui.livemlwidget.line.setData(np.linspace(0, 30, len(self.livex)), self.livex)
-            # Status light
-            if self.status == 'display' and self.ui.statuslight.styleSheet() != ("background-color: green; "
-                                                                                 "border-radius: 10px"):
-                self.ui.statuslight.setStyleSheet("background-color: green; border-radius: 10px")
-            elif self.status == 'disconnected' and self.ui.statuslight.styleSheet() != ("background-color: red; "
-                                                                                        "border-radius: 10px"):
-                self.ui.statuslight.setStyleSheet("background-color: red; border-radius: 10px")
-            elif self.status == 'connected' and self.ui.statuslight.styleSheet() != ("background-color: orange; "
-                                                                                     "border-radius: 10px"):
-                self.ui.statuslight.setStyleSheet("background-color: orange; border-radius: 10px")
-
+            # everything that arrived since the last frame, however many samples that are
+            self.drainlive()
+            # one line per board
+            window = self.config['window']
+            for board in self.live:
+                # views into the ring buffer, nothing is copied
+                livet, livex, livey = self.live[board].view(window)[:3]
+                if not len(livet):
+                    continue
+                self.ui.livestabilogramwidget.boardline(board).setData(livex, livey)
+                # time axis of the window, the latest sample on the right
+                livet = livet - (livet[-1] - window)
+                self.ui.liveapwidget.boardline(board).setData(livet, livey)
+                self.ui.livemlwidget.boardline(board).setData(livet, livex)
+            # Status lights, of the selected source and of the sources added next to it
+            selected = self.sources.get(self.com_port_selected)
+            self.showstatus(self.ui.statuslight, selected)
+            for name, light in list(self.sourcelights.items()):
+                self.showstatus(light, self.sources[name], f"{name}, click to remove")
+            # the diagnostics of the selected source
+            self.diagnostics.setvalues(selected.telemetry[-1] if selected is not None and selected.telemetry and
+                                       selected.status != 'disconnected' else None)
             # status text
             """if self.status != self.ui.statustext.text():
                 self.ui.statustext.setText(self.status)"""
@@ -276,6 +433,16 @@ class STEPviewer:
 
         QApplication.processEvents()
 
+    def showstatus(self, light, source, title=None):
+        """Colour a status light after the state of its source, with the link details in its tooltip."""
+        status = source.status if source is not None else 'disconnected'
+        style = f"background-color: {STATUS_COLORS[status]}; border-radius: 10px"
+        if light.styleSheet() != style:
+            light.setStyleSheet(style)
+        tooltip = '\n'.join(line for line in (title, source.tooltip() if source is not None else None) if line)
+        if light.toolTip() != tooltip:
+            light.setToolTip(tooltip)
+
     def saverecording(self):
 
         def sendtoresearchdrive(data, metadata, mode='excel'):
@@ -311,6 +478,7 @@ class STEPviewer:
 
             # convert calculated variables to dataframe
             variables_df = pd.DataFrame(self.variables, index=[0])
+            telemetry_df = pd.DataFrame(self.recordingtelemetry)
 
             if mode == 'excel':
                 print(f"Converting data to excel...")
@@ -321,6 +489,8 @@ class STEPviewer:
                 data.to_excel(writer, sheet_name="Data", index=False)
                 metadata.to_excel(writer, sheet_name="Metadata", index=False)
                 variables_df.to_excel(writer, sheet_name="Variables", index=False)
+                if len(telemetry_df):
+                    telemetry_df.to_excel(writer, sheet_name="Telemetry", index=False)
                 # Close the Pandas Excel writer and output the Excel file.
                 writer.close()
 
@@ -329,7 +499,9 @@ class STEPviewer:
                 filepath = os.path.join(os.getcwd(), f'{filename}.json')
                 data_json = data.to_json(orient='records')
                 variables_json = variables_df.to_json(orient='records')
-                file = f'{{"metadata": {metadata_json}, "data": {data_json}, "variables": {variables_json}}}'
+                telemetry_json = telemetry_df.to_json(orient='records') if len(telemetry_df) else '[]'
+                file = (f'{{"metadata": {metadata_json}, "data": {data_json}, "variables": {variables_json}, '
+                        f'"telemetry": {telemetry_json}}}')
 
                 # save temporary file locally
                 try:
@@ -369,8 +541,8 @@ class STEPviewer:
 
         filename = QFileDialog.getSaveFileName(self.win, 'Save File', '', 'Excel Files (*.xlsx)')
         import pandas as pd
-        data_df = pd.DataFrame(self.recording, columns=['time', 'x', 'y'])
-        data_df['time'] = data_df['time'].round(2)
+        data_df = pd.DataFrame(self.recording, columns=self.recordingcolumns)
+        data_df['time'] = data_df['time'].round(6)
         data_df['x'] = data_df['x'].round(4)
         data_df['y'] = data_df['y'].round(4)
 
@@ -391,6 +563,8 @@ class STEPviewer:
         metadata_df['practitioner'] = self.config['practitioner']
 
         variables_df = pd.DataFrame(self.variables, index=[0])
+        # health of the Pi sender during the recording
+        telemetry_df = pd.DataFrame(self.recordingtelemetry)
 
         succes = False
         try:
@@ -400,6 +574,8 @@ class STEPviewer:
                 data_df.to_excel(writer, sheet_name='Data', index=False)
                 metadata_df.to_excel(writer, sheet_name='Metadata', index=False)
                 variables_df.to_excel(writer, sheet_name='Variables', index=False)
+                if len(telemetry_df):
+                    telemetry_df.to_excel(writer, sheet_name='Telemetry', index=False)
                 print("File successfully saved locally.")
                 succes = True
         except Exception as e:
@@ -409,9 +585,7 @@ class STEPviewer:
         if succes:
             try:
                 if self.ui.contribute.isChecked():
-                    sendthread = Thread(target=sendtoresearchdrive, args=(data_df, metadata_df))
-                    sendthread.daemon = True
-                    sendthread.start()
+                    self.engine.submit(asyncio.to_thread(sendtoresearchdrive, data_df, metadata_df), 'Upload')
             except Exception as e:
                 print(f"Error while uploading file: {e}")
                 return
@@ -420,7 +594,7 @@ class STEPviewer:
         if not filename:
             options = QFileDialog.Options()
             options |= QFileDialog.ReadOnly
-            filename, _ = QFileDialog.getOpenFileName(self.win, 'Open recording', '', 'Report or raw data (*.xlsx *.json)',
+            filename, _ = QFileDialog.getOpenFileName(self.win, 'Open recording', '', 'Report or raw data (*.xlsx *.json *.step)',
                                                   options=options)
         if filename == '':
             print("No file selected.")
@@ -430,23 +604,40 @@ class STEPviewer:
         if extention == 'xlsx':
             try:
                 import pandas as pd
-                data = pd.read_excel(filename, sheet_name='Data')
-                metadata = pd.read_excel(filename, sheet_name='Metadata')
+                sheets = pd.read_excel(filename, sheet_name=None)
+                data = sheets['Data']
+                metadata = sheets['Metadata']
                 self.recording = data.to_numpy()
+                self.recordingcolumns = [str(column) for column in data.columns]
                 self.recordinginfo = {k: str(v[0]) for k, v in metadata.to_dict().items()}
+                # recordings saved before the telemetry was added have no telemetry sheet
+                telemetry = sheets.get('Telemetry')
+                self.recordingtelemetry = [] if telemetry is None else telemetry.to_dict(orient='records')
                 self.readpatientinfo()
             except Exception as e:
                 print(f"Error while opening file: {e}")
                 return
 
+        elif extention == 'step':
+            try:
+                with open(filename, 'rb') as f:
+                    start_time, self.recording, self.recordingcolumns = self.readsteprecording(f.read())
+                self.recordinginfo = self.newrecordinginfo(start_time, f"{self.recording[-1, 0]:.2f}")
+                self.recordingtelemetry = []
+            except Exception as e:
+                print(f"Error while opening file: {e}")
+                return
+
         elif extention == 'json':
             try:
                 import pandas as pd
                 data = pd.read_json(filename, orient='records', typ='series')
                 metadata = data['metadata']
                 self.recordinginfo = self.recordinginfo | metadata
+                self.recordingtelemetry = list(data['telemetry']) if 'telemetry' in data else []
                 data = data['data']
                 # generate numpy array from json
+                self.recordingcolumns = list(data[0].keys())
                 data = np.array([list(i.values()) for i in data])
                 self.recording = data
                 self.readpatientinfo()
@@ -458,7 +649,9 @@ class STEPviewer:
             return
 
         try:
-            self.analyserecording()
+            self.reprocessrecording()
+            if not self.analyserecording():
+                return
             self.analysisidx = 0
             self.update()
             self.ui.analysisplay.setDisabled(False)
@@ -481,69 +674,186 @@ class STEPviewer:
             print(f"Error opening file, maybe wrong format? error: {e}")
 
     def recorder(self):
-        def record(seconds):
+        async def record(seconds, capacity):
             start_time = datetime.datetime.now()
-            times = []
-            xs = []
-            ys = []
-
-            # record for 10 seconds
-            print(f"Recording for {seconds} seconds...")
-            self.ui.startrecording.setDisabled(True)
+            # the ingest tasks append every sample they receive from now on, on the host clock
+            buffer = RecordingBuffer(seconds, capacity)
             try:
-                self.recordstate = True
-                self.status = 'recording...'
-                while (datetime.datetime.now() - start_time).total_seconds() <= seconds:
-                    times.append((datetime.datetime.now() - start_time).total_seconds())
-                    xs.append(self.livex[-1])
-                    ys.append(self.livey[-1])
-                    sleep(0.01)
+                self.recordbuffer = buffer
+                self.sendcommand('rate', 0)
+                # until a sample beyond the recording length arrives, or the stream stopped
+                await self.engine.wait(buffer.complete, seconds + RECORD_TIMEOUT)
             except Exception as e:
                 print(f"Error while recording: {e}")
-                self.recordstate = False
-                self.status = f"Error while recording: {e}"
-                self.ui.startrecording.setStyleSheet("background-color: none")
-                self.ui.startrecording.setDisabled(False)
+                self.recordbuffer = None
+                self.sendcommand('rate', self.config['idle_rate'])
+                self.engine.ingui(recorded, start_time)
                 return
 
+            self.recordbuffer = None
+            samples = buffer.close()
+            self.sendcommand('rate', self.config['idle_rate'])
+            print(f"Done recording: {buffer.report()}.")
+            boards = {}
+            for board, data in samples.items():
+                if not data.shape[1]:
+                    continue
+                times, values, seqs = data[0], data[1:-1].T, data[-1]
+                if np.isnan(values[:, 2:]).any():
+                    values, fields = values[:, :2], ['x', 'y']
+                else:
+                    # keep the raw sensor values so the recording can be reprocessed later
+                    fields = ['x', 'y', *RAW_FIELDS]
+                # the sequence numbers show which samples are missing from the recording
+                boards[board] = (times, np.column_stack((values, seqs)), fields + ['seq'])
+            # the source and board of every channel, to tell the columns of the boards apart
+            channels = {channel: f"{source.name} board {board + 1}" for source in list(self.sources.values())
+                        for board, channel in source.channels.items() if channel in boards}
+            if boards:
+                # all boards on the time base of the first board, the samples of all sources are on the host clock
+                recording, columns = combine_boards(boards)
+                start = recording[0, 0]
+                recording[:, 0] -= start
+                telemetry = self.telemetrybetween(start, start + recording[-1, 0])
+            else:
+                recording, columns, telemetry = np.empty((0, 3)), ['time', 'x', 'y'], []
+            self.engine.ingui(recorded, start_time, buffer, channels, recording, columns, telemetry)
+
+        def recorded(start_time, buffer=None, channels=None, recording=None, columns=None, telemetry=None):
+            # back in the GUI thread, buffer is None if the recording failed
             self.recordstate = False
-            self.status = "Done recording"
             self.ui.startrecording.setStyleSheet("background-color: none")
-            print("Done recording")
-            self.recording = np.column_stack((times, xs, ys))
-            self.recordinginfo = {"date": start_time.strftime("%d/%m/%Y"),
-                                  "time": start_time.strftime("%H:%M:%S"),
-                                  "duration": self.ui.recordlength.value(),
-                                  "stance": self.ui.stanceselect.currentText(),
-                                  "eyes": self.ui.eyeselect.currentText(),
-                                  "identifier": self.ui.identifierselect.text(),
-                                  "age": self.ui.ageselect.value(),
-                                  "height": self.ui.heightselect.value(),
-                                  "weight": self.ui.weightselect.value(),
-                                  "condition": self.ui.conditionselect.currentText(),
-                                  "medication": self.ui.medicationselect.currentText(),
-                                  "fallhistory": self.ui.fallhistoryselect.currentText(),
-                                  "notes": self.ui.notesedit.toPlainText()}
-
             self.ui.startrecording.setDisabled(False)
+            if buffer is None:
+                return
+            self.recording, self.recordingcolumns, self.recordingtelemetry = recording, columns, telemetry
+            self.recordinginfo = self.newrecordinginfo(start_time, self.ui.recordlength.value())
+            self.recordinginfo.update(received=buffer.received, duplicated=buffer.duplicated, missing=buffer.missing)
+            if len(channels) > 1:
+                self.recordinginfo['boards'] = ', '.join(f"{board_column('x', channel, min(channels))}: {board}"
+                                                         for channel, board in sorted(channels.items()))
             self.ui.analyserecording.setDisabled(False)
 
+        statuses = {source.name: source.status for source in self.sources.values()}
         if self.recordstate:
             print("Already recording.")
             return
-        elif self.status == 'disconnected':
+        elif 'display' in statuses.values():
+            for name, status in statuses.items():
+                if status != 'display':
+                    print(f"Not receiving data from {name}, recording the other sources.")
+            print(f"Recording for {self.ui.recordlength.value()} seconds...")
+            self.ui.startrecording.setDisabled(True)
+            # the recording state belongs to the GUI thread, the ingest tasks only read it
+            self.recordstate = True
+            seconds = self.ui.recordlength.value()
+            self.engine.submit(record(seconds, self.recordcapacity(seconds)), 'Recording')
+        elif 'connected' in statuses.values():
+            print("Connected to COM, but not receiving data.")
+        else:
             print("No balance board connected.")
+
+    def recordcapacity(self, seconds):
+        """
+        Samples per channel to preallocate for a recording. The binary protocol idles at a reduced rate, so the live
+        rate only tells the recording rate when the sender cannot be throttled; otherwise the highest expected rate
+        is used.
+        """
+        rates = [rate for rate in (buffer.rate() for buffer in list(self.live.values())) if rate]
+        throttled = any(source.serial is not None for source in self.sources.values())
+        rate = max(rates) if rates and not throttled else self.config['max_rate']
+        # a tenth more for a clock that runs fast, the buffer grows if that is not enough
+        return int(1.1 * seconds * rate) + 1
+
+    def newrecordinginfo(self, start_time, duration):
+        return {"date": start_time.strftime("%d/%m/%Y"),
+                "time": start_time.strftime("%H:%M:%S"),
+                "duration": duration,
+                "stance": self.ui.stanceselect.currentText(),
+                "eyes": self.ui.eyeselect.currentText(),
+                "identifier": self.ui.identifierselect.text(),
+                "age": self.ui.ageselect.value(),
+                "height": self.ui.heightselect.value(),
+                "weight": self.ui.weightselect.value(),
+                "condition": self.ui.conditionselect.currentText(),
+                "medication": self.ui.medicationselect.currentText(),
+                "fallhistory": self.ui.fallhistoryselect.currentText(),
+                "notes": self.ui.notesedit.toPlainText()}
+
+    def readsteprecording(self, data):
+        """
+        Convert the contents of a .step file recorded on the Pi to a recording, with the boards side by side.
+        Returns the start time, the recording and its column names.
+        """
+        header, samples = read_recording(data)
+        if len(samples) == 0:
+            raise ValueError("Recording contains no samples.")
+        boards_of_samples = samples['board'] if 'board' in samples.dtype.names else np.zeros(len(samples), dtype=int)
+        boards = {}
+        for board in np.unique(boards_of_samples).tolist():
+            board_samples = samples[boards_of_samples == board]
+            seq = board_samples['seq']
+            if header['frame_type'] == FRAME_RAW:
+                raw = raw_values(board_samples)
+                x, y, _ = cop_from_raw(raw, self.config['width'], self.config['length'])
+                values = np.column_stack((x, y, raw, seq))
+                boards[board] = (board_samples['time'], values, ['x', 'y', *RAW_FIELDS, 'seq'])
+            else:
+                cop = np.column_stack((board_samples['x'], board_samples['y'], seq))
+                boards[board] = (board_samples['time'], cop, ['x', 'y', 'seq'])
+        recording, columns = combine_boards(boards)
+        recording[:, 0] -= recording[0, 0]
+        return datetime.datetime.fromtimestamp(header['start_time']), recording, columns
+
+    def telemetrybetween(self, start, end):
+        """
+        Telemetry of the Pi senders between two timestamps of the host clock, with the time relative to the start.
+        With several sources every entry tells the source it came from.
+        """
+        sources = [source for source in list(self.sources.values()) if source.offset is not None]
+        telemetry = []
+        for source in sources:
+            # the telemetry is timestamped by the sender's clock
+            entries = source.telemetrybetween(start - source.offset, end - source.offset)
+            telemetry.extend(dict(entry, source=source.name) if len(sources) > 1 else entry for entry in entries)
+        return sorted(telemetry, key=lambda entry: entry['time'])
+
+    def receiverecording(self, data, source):
+        """
+        Store a recording that was made on a Pi and transferred in bulk by a source, and make it the current
+        recording. Called by the ingest task of the source, the file is written in a worker thread.
+        """
+        if data is None:
+            print("Recording transfer from the Pi failed the integrity check.")
             return
-        elif self.status == 'connected':
-            print("Connected to COM, but not receiving data.")
+        self.engine.loop.run_in_executor(None, self.storerecording, data, source)
+
+    def storerecording(self, data, source):
+        """Save a recording received from a Pi and read it, in a worker thread."""
+        try:
+            import os
+            os.makedirs('recordings', exist_ok=True)
+            filename = os.path.join('recordings', datetime.datetime.now().strftime('STEP_%Y%m%d_%H%M%S.step'))
+            with open(filename, 'wb') as f:
+                f.write(data)
+            print(f"Recording received from the Pi, saved to {filename}")
+            start_time, recording, columns = self.readsteprecording(data)
+        except Exception as e:
+            print(f"Error while receiving recording: {e}")
             return
-        elif self.status == 'display':
-            recordthread = Thread(target=record, args=(self.ui.recordlength.value(),))
-            recordthread.daemon = True
-            recordthread.start()
+        start = start_time.timestamp()
+        # the recording and the telemetry are timestamped by the clock of the same Pi
+        telemetry = source.telemetrybetween(start, start + recording[-1, 0])
+        self.engine.ingui(self.receivedrecording, start_time, recording, columns, telemetry)
 
-        else:
-            print("Unknown error occurred.")
+    def receivedrecording(self, start_time, recording, columns, telemetry):
+        """Make a recording of the Pi that was received the current recording, in the GUI thread."""
+        if self.recordstate:
+            print("Recording in progress, the recording from the Pi was saved but not loaded.")
+            return
+        self.recording, self.recordingcolumns, self.recordingtelemetry = recording, columns, telemetry
+        self.recordinginfo = self.newrecordinginfo(start_time, f"{self.recording[-1, 0]:.2f}")
+        self.ui.analyserecording.setDisabled(False)
 
     def playpause(self):
         if self.mode == 1 and len(self.analysisdata) > 1:
@@ -591,26 +901,40 @@ class STEPviewer:
             self.mode = 0
         else:
             print("Unknown mode.")
+        # start or stop streaming
+        for source in self.sources.values():
+            source.wake()
         self.update()
 
     def analyserecording(self):
+        """Analyse the recording and show it in the analysis tab, returns False if the recording was rejected."""
         def fill_table():
             pass
 
         target_frequency = 100
-        time = self.recording[:, 0]
-        x = self.recording[:, 1]
-        y = self.recording[:, 2]
+        # a regular, increasing time base from the board timestamps, with the short gaps filled in
+        columns = self.recordingcolumns
+        seq = self.recording[:, columns.index('seq')] if 'seq' in columns else None
+        try:
+            time, values, quality = prepare_recording(self.recording[:, 0], self.recording[:, 1:3], seq,
+                                                      self.config['max_gap'], self.config['interpolation'])
+        except ValueError as e:
+            print(f"Cannot analyse the recording: {e}")
+            self.win.statusBar().showMessage(f"Cannot analyse the recording: {e}")
+            return False
+        self.win.statusBar().clearMessage()
+        # the data quality is saved with the recording
+        self.recordinginfo.update(quality)
+        if quality['interpolated']:
+            print(f"Warning: {quality['interpolated']} samples are missing from the recording in {quality['gaps']} "
+                  f"gaps, the longest gap is {quality['longest_gap']} s, they are interpolated.")
+        x, y = values.T
         # normalize time, x and y
         time -= time[0]
         x -= np.mean(x)
         y -= np.mean(y)
         data = np.array([time, x, y]).T
 
-        valid_index = (np.sum(np.isnan(data), axis=1) == 0)
-        if np.sum(valid_index) != len(data):
-            raise ValueError("Clean NaN values first")
-
         stato = Stabilogram()
         stato.from_array(array=data, resample_frequency=target_frequency)
         # add time to stato
@@ -711,6 +1035,7 @@ class STEPviewer:
             self.ui.generalvariables.setItem(i, 1, QTableWidgetItem(str(features[key].round(2))))
             self.ui.generalvariables.setItem(i, 2, QTableWidgetItem(value[2]))
             self.ui.generalvariables.setItem(i, 3, QTableWidgetItem(value[1]))
+        return True
 
 
 
@@ -0,0 +1,113 @@
+"""
+Event loop of the viewer's ingest: one asyncio loop in its own thread runs the readers of the sources, their
+reconnects, the recordings and the uploads as tasks, and hands work for the GUI to the Qt event loop through a signal.
+
+The asyncio loop runs next to the Qt event loop rather than inside it: the asyncio loop of PySide6 (QtAsyncio) cannot
+wait for a file descriptor to become readable, and a serial port on Windows has no descriptor to wait on. A serial port
+with a descriptor is read as soon as it becomes readable; other ports, network sources and serial ports on Windows,
+are read in a worker thread, which returns as soon as bytes arrive as well.
+"""
+import asyncio
+import sys
+import threading
+from PySide6.QtCore import QObject, Signal
+import serial
+
+
+class IngestEngine(QObject):
+    """
+    Runs coroutines on an asyncio loop in a background thread. The tasks wait for asyncio events, which are created on
+    the loop, since on Python 3.9 an event belongs to the loop of the thread that created it, and which other threads
+    set through call(), for example when a source is removed or the mode changes.
+    """
+    _ingui = Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.loop = None
+        self.stopping = False  # set once stop() cancels the tasks, a task that is cancelled for another reason goes on
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ingest')
+        self._thread.daemon = True
+        # the engine lives in the GUI thread, so the signal is delivered there
+        self._ingui.connect(lambda call: call())
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def stop(self, timeout: float = 2.0):
+        """Cancel the tasks and stop the loop, from any thread but the loop's own."""
+        if self.loop is None or not self._thread.is_alive():
+            return
+        self.stopping = True
+        asyncio.run_coroutine_threadsafe(self._cancel(), self.loop)
+        self._thread.join(timeout)
+
+    async def _cancel(self):
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def submit(self, coroutine, name=None):
+        """Run a coroutine as a task on the loop, from any thread. Returns a concurrent.futures.Future."""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(lambda done: self._report(done, name or coroutine.__qualname__))
+        return future
+
+    @staticmethod
+    def _report(future, name):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"{name} stopped: {future.exception()}")
+
+    def call(self, function, *args):
+        """Call a function in the loop's thread: right away from the loop itself, from other threads when it is free."""
+        if threading.current_thread() is self._thread:
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    @staticmethod
+    async def wait(event: asyncio.Event, timeout=None) -> bool:
+        """Wait up to timeout for an event, returns whether it was set. Clears the event."""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            event.clear()
+
+    def ingui(self, function, *args):
+        """Call a function in the GUI thread, from any thread."""
+        self._ingui.emit(lambda: function(*args))
+
+    async def read(self, port, timeout: float = 1.0) -> bytes:
+        """Wait up to timeout for bytes from a port and return all it has, b'' if nothing arrived."""
+        if not isinstance(port, serial.Serial) or sys.platform == 'win32':
+            # the read of the port waits up to its own timeout
+            return await asyncio.to_thread(lambda: port.read(port.in_waiting or 1))
+        if port.in_waiting:
+            return port.read(port.in_waiting)
+        readable = self.loop.create_future()
+        fd = port.fileno()
+        self.loop.add_reader(fd, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            return b''
+        finally:
+            self.loop.remove_reader(fd)
+        # a port that is readable without data was unplugged, reading it raises the SerialException
+        return port.read(port.in_waiting or 1)
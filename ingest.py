@@ -0,0 +1,326 @@
+"""
+Host side processing of the samples received from the STEP Pi sender.
+"""
+import asyncio
+import threading
+from collections import deque
+import numpy as np
+
+# sensor fields of a raw frame, top left, top right, bottom left, bottom right
+RAW_FIELDS = ('tl', 'tr', 'bl', 'br')
+
+# default board geometry in mm
+BOARD_WIDTH = 433
+BOARD_LENGTH = 228
+
+# sequence numbers of the sender wrap around at 2**32
+SEQ_MODULO = 1 << 32
+
+# longest gap in seconds that is filled in before analysis, recordings with longer gaps are rejected
+MAX_GAP = 0.1
+# ways to fill in a short gap: straight line, last sample before the gap, or the nearest sample
+INTERPOLATIONS = ('linear', 'previous', 'nearest')
+
+# fields of a sample in the live buffer, the raw sensor values are NaN when the sender streams the center of pressure
+LIVE_FIELDS = ('time', 'x', 'y', *RAW_FIELDS, 'seq')
+
+
+def raw_values(frames):
+    """Return the raw sensor values of a structured array of raw frames as a (n, 4) float array."""
+    return np.column_stack([frames[field] for field in RAW_FIELDS]).astype(np.float64)
+
+
+def cop_from_raw(raw, width=BOARD_WIDTH, length=BOARD_LENGTH):
+    """
+    Compute the center of pressure for a whole batch of raw sensor values at once.
+    raw is a (n, 4) array ordered as RAW_FIELDS, in the units the board reports (1/100 kg).
+    Returns the x and y center of pressure in mm and the total weight in kg.
+    Samples without any load give a NaN center of pressure.
+    """
+    raw = np.asarray(raw, dtype=np.float64)
+    tl, tr, bl, br = raw.T
+    total = raw.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = width / 2 * (tr + bl - tl - br) / total
+        y = length / 2 * (tl + tr - bl - br) / total
+    return x, y, total / 100
+
+
+def seq_gaps(seq, previous=None):
+    """
+    Number of samples missing before every sample of a stream, from the sequence numbers the sender gave them.
+    previous is the sequence number of the sample before the first one, if there is one. Repeated sequence numbers
+    and steps back (more than half the range ahead after wrapping) are a restart of the sender, not a gap.
+    """
+    seq = np.asarray(seq, dtype=np.int64)
+    if not len(seq):
+        return np.zeros(0, dtype=np.int64)
+    steps = np.diff(seq, prepend=seq[0] - 1 if previous is None else previous) % SEQ_MODULO
+    gaps = steps - 1
+    gaps[(steps == 0) | (steps > SEQ_MODULO // 2)] = 0
+    return gaps
+
+
+def board_column(name, board, primary=0):
+    """Column name of a field of a board in a recording, the fields of the primary board keep their plain name."""
+    return name if board == primary else f"{name}_{board}"
+
+
+def combine_boards(boards):
+    """
+    Combine the samples of several boards into one recording on the time base of the primary (lowest id) board.
+    boards maps a board id to (times, values, names): the board timestamps, a (n, k) array of values and the k field
+    names. The boards share one clock, the Pi's clock for the boards of one sender and the host clock for the boards of
+    several sources, so the other boards are interpolated linearly at the timestamps of the primary board, outside
+    their own time range they are NaN. A 'seq' field marks samples that never arrived: the primary board keeps its seq
+    column, the other boards are NaN inside their gaps instead of interpolated across them.
+    Returns the recording with the time in the first column, and the column names.
+    """
+    primary = min(boards)
+    times = np.sort(np.asarray(boards[primary][0], dtype=np.float64), kind='stable')
+    columns = [times]
+    names = ['time']
+    for board in sorted(boards):
+        board_times, values, fields = boards[board]
+        board_times = np.asarray(board_times, dtype=np.float64)
+        order = np.argsort(board_times, kind='stable')
+        board_times = board_times[order]
+        values = np.asarray(values, dtype=np.float64).reshape(len(board_times), -1)[order]
+        ingap = np.zeros(len(times), dtype=bool)
+        if board != primary and 'seq' in fields and len(board_times):
+            # primary timestamps that fall between two samples of this board with missing samples in between
+            gaps = seq_gaps(values[:, list(fields).index('seq')])
+            after = np.searchsorted(board_times, times, side='right')
+            inside = (after > 0) & (after < len(board_times))
+            ingap[inside] = (gaps[after[inside]] > 0) & (times[inside] > board_times[after[inside] - 1])
+        for i, name in enumerate(fields):
+            if board != primary and name == 'seq':
+                continue
+            if board == primary:
+                columns.append(values[:, i])
+            elif len(board_times):
+                column = np.interp(times, board_times, values[:, i], left=np.nan, right=np.nan)
+                column[ingap] = np.nan
+                columns.append(column)
+            else:
+                columns.append(np.full(len(times), np.nan))
+            names.append(board_column(name, board, primary))
+    return np.column_stack(columns), names
+
+
+def prepare_recording(times, values, seq=None, max_gap=MAX_GAP, interpolation='linear'):
+    """
+    Check a recording and put it on a regular, increasing time base before it is analysed.
+    times are the timestamps of the samples, values a (n, k) array and seq their sequence numbers, if known.
+    Samples are sorted by time; samples with a NaN value or a timestamp that repeats the previous one are dropped.
+    The sample period is the median time step. Samples are missing where the sequence numbers skip, or without them
+    where the time step spans more than one period; gaps up to max_gap seconds are filled in with one of
+    INTERPOLATIONS.
+    Returns the time base, the values on it and a summary of the data quality, which counts the samples interpolated
+    into the gaps rather than the missing samples the recorder counts.
+    Raises ValueError for a recording with a longer gap or fewer than two valid samples.
+    """
+    if interpolation not in INTERPOLATIONS:
+        raise ValueError(f"Unknown interpolation: {interpolation}")
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).reshape(len(times), -1)
+    quality = {'samples': len(times), 'unordered': int(np.count_nonzero(np.diff(times) < 0))}
+    order = np.argsort(times, kind='stable') if quality['unordered'] else np.arange(len(times))
+    valid = np.isfinite(times[order]) & np.isfinite(values[order]).all(axis=1)
+    quality['invalid'] = int(len(valid) - np.count_nonzero(valid))
+    order = order[valid]
+    times, values = times[order], values[order]
+    repeated = np.concatenate(([False], np.diff(times) == 0))
+    quality['repeated'] = int(np.count_nonzero(repeated))
+    times, values = times[~repeated], values[~repeated]
+    if len(times) < 2:
+        raise ValueError("The recording has fewer than two valid samples.")
+
+    steps = np.diff(times)
+    period = float(np.median(steps))
+    # samples missing before every sample but the first: the sequence numbers are exact, without them a time step of
+    # more than one and a half period is a gap
+    if seq is not None:
+        missing = seq_gaps(np.asarray(seq)[order][~repeated])[1:]
+    else:
+        missing = np.maximum(np.rint(steps / period).astype(np.int64) - 1, 0)
+    gaps = missing > 0
+    longest = float(steps[gaps].max()) if gaps.any() else 0.0
+    quality.update(rate=round(1 / period, 2), interpolated=int(missing.sum()), gaps=int(np.count_nonzero(gaps)),
+                   longest_gap=round(longest, 4))
+    if longest > max_gap:
+        start = times[:-1][gaps & (steps > max_gap)][0] - times[0]
+        raise ValueError(f"The recording has a gap of {longest:.3f} s after {start:.2f} s, longer than the {max_gap} s "
+                         f"that can be filled in.")
+
+    base = times[0] + period * np.arange(int(round((times[-1] - times[0]) / period)) + 1)
+    if interpolation == 'linear':
+        filled = np.column_stack([np.interp(base, times, column) for column in values.T])
+    else:
+        after = np.clip(np.searchsorted(times, base), 1, len(times) - 1)
+        if interpolation == 'previous':
+            index = np.where(times[after] <= base, after, after - 1)
+        else:
+            index = np.where(times[after] - base < base - times[after - 1], after, after - 1)
+        filled = values[index]
+    return base, filled, quality
+
+
+class LiveBuffer:
+    """
+    Preallocated ring buffer with the latest samples of one board for the live display, written by the GUI with the
+    batches of the ingest thread (see BatchQueue) and read by the plots and the recorder. The fields are rows of one
+    array, ordered as LIVE_FIELDS.
+
+    Every sample is stored twice, at its position and one capacity further, so the latest samples are always one
+    contiguous slice: view() returns them without copying. The buffer holds `margin` samples more than the window that
+    can be viewed; the writer fills those first, so a view that was handed out stays intact as long as fewer than
+    margin samples are written before it is drawn.
+    """
+
+    def __init__(self, window: int, margin: int):
+        self.window = window
+        self.capacity = window + margin
+        self._data = np.full((len(LIVE_FIELDS), 2 * self.capacity), np.nan)
+        self._lock = threading.Lock()
+        self.count = 0  # samples written since the buffer was created
+
+    def __len__(self):
+        return min(self.count, self.window)
+
+    def extend(self, samples):
+        """Append a (len(LIVE_FIELDS), n) array of samples."""
+        samples = np.asarray(samples, dtype=np.float64)
+        n = samples.shape[1]
+        if n > self.capacity:
+            samples = samples[:, -self.capacity:]
+        with self._lock:
+            start = (self.count + n - samples.shape[1]) % self.capacity
+            first = min(samples.shape[1], self.capacity - start)
+            for offset in (0, self.capacity):
+                self._data[:, offset + start:offset + start + first] = samples[:, :first]
+                self._data[:, offset:offset + samples.shape[1] - first] = samples[:, first:]
+            self.count += n
+
+    def view(self, seconds=None):
+        """
+        The latest samples as a (len(LIVE_FIELDS), n) view into the buffer, at most `window` of them and only those
+        of the last `seconds` seconds if given. Do not write to it.
+        """
+        with self._lock:
+            end = self.count % self.capacity + self.capacity
+            window = self._data[:, end - len(self):end]
+        if seconds is not None and window.shape[1]:
+            times = window[0]
+            window = window[:, np.searchsorted(times, times[-1] - seconds):]
+        return window
+
+    def rate(self):
+        """Sample rate in Hz over the samples in the window, None with less than two samples."""
+        times = self.view()[0]
+        if len(times) < 2 or not times[-1] > times[0]:
+            return None
+        return (len(times) - 1) / (times[-1] - times[0])
+
+
+class RecordingBuffer:
+    """
+    Every sample of every board during a recording, appended by the ingest tasks as the batches arrive. The samples
+    of a board go into a preallocated (len(LIVE_FIELDS), capacity) array, which only grows if the board sends faster
+    than it was sized for. The recording lasts `seconds` from its first sample; complete is set once every board that
+    recorded sent a sample beyond that, so a board whose samples arrive later than those of the others still records
+    its last samples. complete is an asyncio event, the buffer is created and extended on the loop of the ingest
+    engine.
+
+    received counts every sample that arrived, duplicated the samples that repeat the sequence number of the sample
+    before them, which are not recorded, and missing the samples the sender numbered that never arrived.
+    """
+
+    def __init__(self, seconds: float, capacity: int):
+        self.seconds = seconds
+        self.capacity = max(int(capacity), 1)
+        self.start = None  # time of the first sample
+        self.complete = asyncio.Event()
+        self.received = 0
+        self.duplicated = 0
+        self.missing = 0
+        self._data = {}
+        self._count = {}
+        self._lastseq = {}
+        self._ended = set()  # boards that sent a sample beyond the end of the recording
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def extend(self, board, samples):
+        """Append a (len(LIVE_FIELDS), n) array of samples of a board."""
+        with self._lock:
+            if self._closed or not samples.shape[1]:
+                return
+            if self.start is None:
+                self.start = samples[0, 0]
+            inside = samples[0] < self.start + self.seconds
+            if not inside.all():
+                self._ended.add(board)
+                samples = samples[:, inside]
+            self._append(board, samples)
+            if self._ended and self._ended.issuperset(self._data):
+                self.complete.set()
+
+    def _append(self, board, samples):
+        """Append the samples of a board that are inside the recording, without the repeated ones."""
+        seq = samples[-1].astype(np.int64)
+        if not len(seq):
+            return
+        previous = self._lastseq.get(board)
+        repeated = np.diff(seq, prepend=seq[0] - 1 if previous is None else previous) % SEQ_MODULO == 0
+        self.received += len(seq)
+        self.duplicated += int(np.count_nonzero(repeated))
+        self.missing += int(seq_gaps(seq, previous).sum())
+        self._lastseq[board] = int(seq[-1])
+        samples = samples[:, ~repeated]
+        if board not in self._data:
+            self._data[board] = np.empty((len(LIVE_FIELDS), max(self.capacity, samples.shape[1])))
+            self._count[board] = 0
+        data, count = self._data[board], self._count[board]
+        if count + samples.shape[1] > data.shape[1]:
+            grown = np.empty((len(LIVE_FIELDS), max(2 * data.shape[1], count + samples.shape[1])))
+            grown[:, :count] = data[:, :count]
+            self._data[board] = data = grown
+        data[:, count:count + samples.shape[1]] = samples
+        self._count[board] = count + samples.shape[1]
+
+    def close(self) -> dict:
+        """Stop recording, returns board id: (len(LIVE_FIELDS), n) array of the recorded samples."""
+        with self._lock:
+            self._closed = True
+            return {board: data[:, :self._count[board]] for board, data in self._data.items()}
+
+    def report(self) -> str:
+        return f"{self.received} samples received, {self.duplicated} duplicated, {self.missing} missing"
+
+
+class BatchQueue:
+    """
+    Queue of sample batches from one producer thread to one consumer thread, without a lock: deque.append and
+    deque.popleft are atomic, and only the producer appends while only the consumer pops. The consumer takes all
+    batches that arrived since its last drain at once, so every batch is taken exactly once, in order, and a slow
+    consumer gets more samples per drain instead of falling behind.
+    """
+
+    def __init__(self):
+        self._batches = deque()
+
+    def __len__(self):
+        return len(self._batches)
+
+    def put(self, batch):
+        """Called by the producer only."""
+        self._batches.append(batch)
+
+    def drain(self) -> list:
+        """Called by the consumer only, returns the batches that arrived since the last drain, oldest first."""
+        batches = []
+        # only take what was there when the drain started, a fast producer cannot keep the consumer busy
+        for _ in range(len(self._batches)):
+            batches.append(self._batches.popleft())
+        return batches
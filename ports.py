@@ -0,0 +1,54 @@
+"""
+Watches the serial ports of the system in the background, so the ingest loop never waits for the port enumeration.
+
+Listing the ports takes tens of milliseconds up to seconds on Windows, so it runs in its own thread at a slow cadence,
+or right away when rescan() is called, for example after a connection was lost. Only a change of the list is
+published, through a Qt signal, so the combo box is updated in the GUI thread.
+"""
+import threading
+from PySide6.QtCore import QObject, Signal
+from serial.tools import list_ports
+
+# seconds between two scans of the serial ports
+PORT_SCAN_INTERVAL = 2.0
+
+
+class PortWatcher(QObject):
+    """
+    Publishes the serial ports, without the Bluetooth ports, followed by the network sources of the config, whenever
+    that list changes.
+    """
+    changed = Signal(list)
+
+    def __init__(self, sources: list = (), interval: float = PORT_SCAN_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.sources = list(sources)
+        self.interval = interval
+        self._ports = None  # last published list, None until the first scan
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='portwatcher')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def rescan(self):
+        """Scan again now instead of at the next interval."""
+        self._wake.set()
+
+    def scan(self) -> list:
+        ports = [port.device for port in list_ports.comports() if 'Bluetooth' not in port.description]
+        return sorted(ports) + [source for source in self.sources if source not in ports]
+
+    def run(self):
+        while True:
+            try:
+                ports = self.scan()
+            except Exception as e:
+                print(f"Error while listing the serial ports: {e}")
+                ports = None
+            if ports is not None and ports != self._ports:
+                self._ports = ports
+                self.changed.emit(ports)
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,302 @@
+"""
+Replays a recording as if it came from a Pi sender, over a pseudo-terminal, to test the viewer without hardware.
+
+    python replay.py testrecordings/STEP_dummyrecording.xlsx --speed 10 --link /tmp/ttySTEP
+
+The viewer opens the pty like a COM port: add the device, or the --link path, to the sources in the [NETWORK] section
+of the config. Recordings saved by the viewer (xlsx or json) and CSV files with a header (time, x, y and optionally
+the raw sensor values and the columns of more boards) can be replayed. The samples are sent in the wire format of
+PI/step_pi_sender.py, binary frames with commands, telemetry and link tests, or the original text lines.
+
+At a speed above 1 the board is emulated as a board that runs that many times faster: the timestamps advance with the
+wall clock, so the sample rate goes up with the speed. Jitter, dropped samples and garbage bytes can be injected to
+measure the ingest throughput, the robustness of the decoder and the frame time of the GUI under stress.
+Only runs on systems with pseudo-terminals, such as Linux and macOS.
+"""
+import os
+import re
+import time
+import random
+import argparse
+import tty
+import numpy as np
+from PI.step_protocol import FRAME_COP, FRAME_RAW, FRAME_RESPONSE, FRAME_TELEMETRY, COMMANDS, STATUS_OK, \
+    STATUS_ERROR, encode_frame, encode_file, encode_text, parse_command, test_pattern
+from ingest import RAW_FIELDS
+
+# seconds between two telemetry frames
+TELEMETRY_INTERVAL = 1.0
+# largest number of garbage bytes injected at once
+MAX_GARBAGE = 32
+# bytes waiting for the viewer above which new samples are discarded, like the ring buffer of the Pi sender
+MAX_PENDING = 1 << 16
+
+
+def load_recording(path: str):
+    """Read a recording, returns its column names and a (n, columns) float array."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.xlsx':
+        import pandas as pd
+        data = pd.read_excel(path, sheet_name='Data')
+        return [str(column) for column in data.columns], data.to_numpy(dtype=np.float64)
+    if extension == '.json':
+        import pandas as pd
+        records = pd.read_json(path, orient='records', typ='series')['data']
+        return list(records[0].keys()), np.array([list(record.values()) for record in records], dtype=np.float64)
+    if extension == '.csv':
+        with open(path) as f:
+            columns = [column.strip() for column in f.readline().split(',')]
+        return columns, np.loadtxt(path, delimiter=',', skiprows=1, ndmin=2)
+    raise ValueError(f"Unknown recording format: {extension}")
+
+
+def split_boards(columns: list, data):
+    """
+    The samples of every board in the recording, board id: (times, cop, raw). raw is None when the recording has no
+    raw sensor values for the board. The other boards have their board id as suffix, their missing samples are NaN.
+    """
+    if 'time' not in columns:
+        # recordings without column names: time, x and y
+        columns = ['time', 'x', 'y'] + columns[3:]
+    times = data[:, columns.index('time')]
+    times = times - np.nanmin(times)
+    boards = {}
+    for column in columns:
+        match = re.fullmatch(r'x(?:_(\d+))?', column)
+        if not match or f"y{column[1:]}" not in columns:
+            continue
+        suffix = column[1:]
+        board = int(match.group(1) or 0)
+        cop = data[:, [columns.index(column), columns.index('y' + suffix)]]
+        fields = [field + suffix for field in RAW_FIELDS]
+        raw = data[:, [columns.index(field) for field in fields]] if all(f in columns for f in fields) else None
+        valid = ~np.isnan(cop).any(axis=1) & ~np.isnan(times)
+        boards[board] = (times[valid], cop[valid], None if raw is None else raw[valid])
+    if not boards:
+        raise ValueError("The recording has no x and y columns.")
+    return boards
+
+
+class Replay:
+    """State of the emulated sender: the stream settings the viewer can change, and the faults to inject."""
+
+    def __init__(self, fd: int, args, boards: dict):
+        self.fd = fd
+        self.protocol = args.protocol
+        self.mode = args.mode
+        self.streaming = True
+        self.rate = 0.0
+        self.boards = boards
+        self.jitter = args.jitter
+        self.drop = args.drop
+        self.garbage = args.garbage
+        self.seq = {board: 0 for board in boards}
+        self.next_send = {board: 0.0 for board in boards}
+        self.pending = b''
+        self._commands = b''
+        self._telemetry = time.monotonic()
+        self._cpu = time.process_time()
+        # counters
+        self.sent = 0
+        self.dropped = 0
+        self.discarded = 0
+        self.garbage_bytes = 0
+        self.bytes_written = 0
+
+    def encode(self, board: int, timestamp: float, cop, raw) -> bytes:
+        """Encode one sample, or return nothing if it is dropped or decimated away. Dropped samples leave a seq gap."""
+        if self.rate:
+            if timestamp < self.next_send[board]:
+                return b''
+            self.next_send[board] = max(self.next_send[board] + 1 / self.rate, timestamp)
+        seq = self.seq[board]
+        self.seq[board] += 1
+        if self.drop and random.random() < self.drop:
+            self.dropped += 1
+            return b''
+        self.sent += 1
+        if self.protocol == 'text':
+            return encode_text([round(float(i), 4) for i in cop] + [round(timestamp, 6)])
+        if self.mode == 'raw':
+            return encode_frame(FRAME_RAW, seq, timestamp, raw, board)
+        return encode_frame(FRAME_COP, seq, timestamp, cop, board)
+
+    def send(self, message: bytes):
+        """Queue a message for the viewer and write what the pty takes, injecting jitter and garbage."""
+        if not message:
+            return self.flush()
+        if len(self.pending) > MAX_PENDING:
+            self.discarded += 1
+            return self.flush()
+        if self.garbage and random.random() < self.garbage:
+            noise = os.urandom(random.randint(1, MAX_GARBAGE))
+            self.garbage_bytes += len(noise)
+            message = noise + message
+        if self.jitter:
+            time.sleep(random.uniform(0, self.jitter))
+        self.pending += message
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        try:
+            written = os.write(self.fd, self.pending)
+        except (BlockingIOError, OSError):
+            # the pty is full, or no viewer has it open
+            return
+        self.bytes_written += written
+        self.pending = self.pending[written:]
+
+    def poll_commands(self):
+        """Answer the commands of the viewer, like the Pi sender does with the binary protocol."""
+        try:
+            self._commands += os.read(self.fd, 4096)
+        except (BlockingIOError, OSError):
+            return
+        *lines, self._commands = self._commands.split(b'\n')
+        for line in lines:
+            if not line.strip() or self.protocol != 'binary':
+                continue
+            try:
+                command_id, command, argument = parse_command(line)
+                status, value = self.handle(command, argument)
+            except (TypeError, ValueError) as e:
+                print(e)
+                continue
+            print(f"Command: {line.decode().strip()}")
+            self.send(encode_frame(FRAME_RESPONSE, command_id, time.time(), (COMMANDS[command], status, value)))
+            if status == STATUS_OK and command == 'test':
+                self.send(encode_file(test_pattern(int(value)), time.time()))
+
+    def handle(self, command: str, argument):
+        if command == 'start':
+            self.streaming = True
+        elif command == 'stop':
+            self.streaming = False
+        elif command == 'rate':
+            self.rate = max(0.0, float(argument))
+            return STATUS_OK, self.rate
+        elif command == 'mode':
+            if argument == 'raw' and any(raw is None for _, _, raw in self.boards.values()):
+                return STATUS_ERROR, 0
+            self.mode = argument
+        elif command == 'ping':
+            return STATUS_OK, time.time()
+        elif command == 'baud':
+            # a pty has no baud rate, every rate works
+            return STATUS_OK, int(argument)
+        elif command == 'test':
+            return STATUS_OK, int(argument)
+        elif command == 'record':
+            return STATUS_ERROR, 0
+        return STATUS_OK, 0
+
+    def telemetry(self):
+        """A telemetry frame every TELEMETRY_INTERVAL seconds, the lost samples are the injected drops."""
+        wall, cpu = time.monotonic(), time.process_time()
+        if self.protocol != 'binary' or wall - self._telemetry < TELEMETRY_INTERVAL:
+            return
+        load = 100 * (cpu - self._cpu) / (wall - self._telemetry)
+        self._telemetry, self._cpu = wall, cpu
+        values = (load, float('nan'), 0, self.dropped, 0, len(self.pending), self.discarded, self.bytes_written,
+                  len(self.boards))
+        self.send(encode_frame(FRAME_TELEMETRY, 0, time.time(), values))
+
+
+def replay(replayer: Replay, boards: dict, speed: float, loop: bool, report: float):
+    """Send the samples of all boards when they are due, at speed times the recorded rate."""
+    order = sorted((times[i], board, i) for board, (times, _, _) in boards.items() for i in range(len(times)))
+    duration = order[-1][0]
+    start_wall, start = time.time(), time.monotonic()
+    last_report, last_sent = start, 0
+    offset = 0.0  # recording time of the start of the current pass
+    i = 0
+    while True:
+        elapsed = (time.monotonic() - start) * speed
+        message = b''
+        while i < len(order) and offset + order[i][0] <= elapsed:
+            t, board, index = order[i]
+            times, cop, raw = boards[board]
+            if replayer.streaming:
+                timestamp = start_wall + (offset + t) / speed
+                message += replayer.encode(board, timestamp, cop[index], None if raw is None else raw[index])
+            i += 1
+        replayer.send(message)
+        replayer.poll_commands()
+        replayer.telemetry()
+        if report and time.monotonic() - last_report >= report:
+            rate = (replayer.sent - last_sent) / (time.monotonic() - last_report)
+            print(f"{rate:.0f} samples/s, {replayer.sent} sent, {replayer.dropped} dropped, "
+                  f"{replayer.discarded} writes discarded, {replayer.garbage_bytes} garbage bytes")
+            last_report, last_sent = time.monotonic(), replayer.sent
+        if i == len(order):
+            if not loop:
+                return
+            # the next pass continues the timestamps and sequence numbers
+            offset += duration + (duration / max(len(order) - 1, 1))
+            i = 0
+        time.sleep(0.001)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recording over a pseudo-terminal as if it came from a "
+                                                 "Pi sender.")
+    parser.add_argument('recording', help="recording to replay, xlsx, json or csv")
+    parser.add_argument('--speed', type=float, default=1, help="replay speed, 1 to 50 times the recorded rate")
+    parser.add_argument('--protocol', choices=('binary', 'text'), default='binary', help="wire protocol")
+    parser.add_argument('--mode', choices=('cop', 'raw'), default='cop',
+                        help="send the center of pressure, or the raw sensor values if the recording has them")
+    parser.add_argument('--loop', action='store_true', help="replay the recording over and over")
+    parser.add_argument('--jitter', type=float, default=0, metavar='SECONDS',
+                        help="delay every write by a random time of up to SECONDS")
+    parser.add_argument('--drop', type=float, default=0, metavar='PROBABILITY',
+                        help="drop samples with this probability, they leave a gap in the sequence numbers")
+    parser.add_argument('--garbage', type=float, default=0, metavar='PROBABILITY',
+                        help="insert random bytes before a write with this probability")
+    parser.add_argument('--link', metavar='PATH', help="create a symlink to the pty, so the viewer config can stay")
+    parser.add_argument('--report', type=float, default=0, metavar='SECONDS',
+                        help="print the replay rate every SECONDS seconds")
+    parser.add_argument('--seed', type=int, help="seed of the injected faults, for repeatable runs")
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 50:
+        parser.error("--speed must be between 1 and 50")
+    if args.mode == 'raw' and args.protocol != 'binary':
+        parser.error("--mode raw needs the binary protocol")
+    random.seed(args.seed)
+
+    boards = split_boards(*load_recording(args.recording))
+    if args.mode == 'raw' and any(raw is None for _, _, raw in boards.values()):
+        parser.error("--mode raw needs a recording with raw sensor values")
+    if args.protocol == 'text' and len(boards) > 1:
+        print("The text protocol has no board id, only the first board is replayed.")
+        boards = {min(boards): boards[min(boards)]}
+
+    master, slave = os.openpty()
+    # no echo and no line translation, the viewer gets the bytes as they are sent. The slave stays open, so the pty
+    # keeps these settings and stays usable while no viewer has it open.
+    tty.setraw(slave)
+    name = os.ttyname(slave)
+    os.set_blocking(master, False)
+    if args.link:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(name, args.link)
+    samples = sum(len(times) for times, _, _ in boards.values())
+    print(f"Replaying {samples} samples of {len(boards)} board(s) on {name} at {args.speed:g}x, "
+          f"protocol: {args.protocol}, mode: {args.mode}.")
+    replayer = Replay(master, args, boards)
+    try:
+        replay(replayer, boards, args.speed, args.loop, args.report)
+        # give the viewer the rest of the data
+        deadline = time.monotonic() + 5
+        while replayer.pending and time.monotonic() < deadline:
+            replayer.flush()
+            time.sleep(0.01)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.link and os.path.islink(args.link):
+            os.remove(args.link)
+    print(f"{replayer.sent} samples sent, {replayer.dropped} dropped, {replayer.discarded} writes discarded, "
+          f"{replayer.garbage_bytes} garbage bytes, {replayer.bytes_written} bytes written.")
@@ -0,0 +1,451 @@
+"""
+A source of the viewer: a serial port or a network source with a Pi sender behind it, and everything the viewer keeps
+about its link. Every source runs its own ingest task on the loop of the ingest engine, so several boards or Pis are
+read at the same time and a source that is slow or fails does not hold up the others.
+
+Commands are written by a writer task of the source in a worker thread, so a port that does not take its data only
+holds up its own commands.
+
+Every sender has its own clock. A source estimates the offset of its sender's clock to the host clock as the smallest
+difference between the arrival of a batch and the timestamp of its newest sample over the last OFFSET_WINDOW seconds,
+the batch that arrived with the least delay. Its samples are put on the host clock with that offset, so the samples of
+all sources share one time base. The estimate starts over with every stream, since the sender may have been restarted
+with its clock set differently, and it is not changed during a recording, which would shift the samples halfway.
+"""
+import asyncio
+import time
+from collections import deque
+from threading import Lock
+import numpy as np
+from PI.step_protocol import FRAME_COP, FRAME_RAW, FRAME_FILE, FRAME_RESPONSE, FRAME_TELEMETRY, PAYLOAD_FIELDS, \
+    STATUS_OK, detect_protocol, get_decoder, encode_command, test_pattern
+from transport import open_source
+from ingest import RAW_FIELDS, raw_values, cop_from_raw, seq_gaps
+
+# seconds of data the link test sends at every baud rate that is tried
+LINK_TEST_SECONDS = 0.25
+# seconds the Pi sender waits for a new baud rate to be confirmed before it falls back
+BAUD_CONFIRM = 2.0
+# number of telemetry frames of the Pi sender that are kept, an hour at the default interval
+TELEMETRY_HISTORY = 3600
+# seconds before a source that failed is opened again, doubled after every failure up to the maximum
+RECONNECT_DELAY = 0.1
+RECONNECT_MAX_DELAY = 2.0
+# seconds of batches the clock offset of a sender is estimated over, so the estimate follows a clock that is stepped
+OFFSET_WINDOW = 10.0
+# seconds between the batches of a sender without timestamps up to which its samples are spread over the time between
+SPREAD_MAX = 1.0
+
+
+class Source:
+    """
+    The link to one sender. The viewer is the STEPviewer the source hands its samples, recordings and port errors to;
+    its config, engine, mode and recording state are read from there.
+    """
+
+    def __init__(self, name, viewer):
+        self.name = name
+        self.viewer = viewer
+        self.config = viewer.config
+        self.engine = viewer.engine
+        # set when the source is removed or the mode changed, created by the ingest task so it belongs to the loop
+        self.changed = None
+        self.closed = False
+        self.status = 'disconnected'
+        # control channel to the Pi sender, only available with the binary protocol
+        self.serial = None
+        self.serial_lock = Lock()
+        self.outgoing = None  # (command, bytes) the writer task of the stream has to write
+        self.writer = None
+        self.command_id = 0
+        self.commands = {}  # command id: (command, time sent)
+        self.awaiting = {}  # command id: (status, value) of the response, None until it arrives
+        self.latency = None
+        # link speed: current baud rate, bytes received in the current second and the measured throughput in bytes/s
+        self.baudrate = None
+        self.linkbytes = 0
+        self.linkstart = time.monotonic()
+        self.throughput = None
+        self.linktest = None  # bulk transfers received during a link test
+        self.decoder = None  # decoder of the current stream, counts the lines and frames it had to skip
+        self.telemetry = []  # telemetry of the Pi sender, oldest first
+        self.weight = {}
+        # sequence number of the last sample and the number of samples that never arrived, per board
+        self.lastseq = {}
+        self.lostsamples = {}
+        self.offset = None  # seconds from the sender's clock to the host clock
+        # (arrival, offset) of the batches of the last OFFSET_WINDOW seconds that can still be the smallest offset
+        self.offsets = deque()
+        self.arrivals = {}  # host time the last batch of a sender without timestamps arrived, per board
+        self.channels = {}  # board id of the sender: channel of the viewer
+
+    def close(self):
+        """Stop the ingest task of the source, from any thread."""
+        self.closed = True
+        self.wake()
+
+    def wake(self):
+        """Have the ingest task look at the mode and whether the source was closed again, from any thread."""
+        self.engine.call(lambda: self.changed is None or self.changed.set())
+
+    async def run(self):
+        """
+        Keep the source open while the live tab is shown. A change of the mode or the removal of the source stops the
+        stream right away; after an error the source is opened again, quickly at first and then less and less often.
+        """
+        self.changed = asyncio.Event()
+        delay = RECONNECT_DELAY
+        while not self.closed:
+            if self.viewer.mode != 0:
+                await self.engine.wait(self.changed)
+                continue
+            started = time.monotonic()
+            stream = asyncio.ensure_future(self.stream())
+            changed = asyncio.ensure_future(self.engine.wait(self.changed))
+            await asyncio.wait((stream, changed), return_when=asyncio.FIRST_COMPLETED)
+            if changed.done() and not changed.cancelled() and changed.exception() is not None:
+                # waiting for a change failed, the settings did not change: end the stream and report the error
+                stream.cancel()
+                await asyncio.gather(stream, return_exceptions=True)
+                raise changed.exception()
+            if not stream.done():
+                # the analysis tab, or the source was removed
+                stream.cancel()
+            changed.cancel()
+            try:
+                await stream
+            except asyncio.CancelledError:
+                if self.engine.stopping:
+                    raise
+                delay = RECONNECT_DELAY
+            except OSError as e:
+                # a SerialException, or an unplugged port that fails in the operating system
+                print(f"An error occurred on {self.name}: {e} \n Trying to reconnect...")
+                # the port may be gone, list the ports again rather than at the next interval
+                self.viewer.portwatcher.rescan()
+                self.status = 'disconnected'
+                delay = RECONNECT_DELAY if time.monotonic() - started > RECONNECT_MAX_DELAY else \
+                    min(2 * delay, RECONNECT_MAX_DELAY)
+                await self.engine.wait(self.changed, delay)
+        self.status = 'disconnected'
+
+    async def stream(self):
+        """Read the source and dispatch what it sends, until it fails or the task is cancelled."""
+        print(f"Opening {self.name}...")
+        # connecting to a network source can take up to the timeout
+        opening = asyncio.ensure_future(asyncio.to_thread(open_source, self.name, self.config['baudrate'], 1))
+        try:
+            ser = await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            # the worker thread still opens the port, close it as soon as it is open
+            opening.add_done_callback(lambda done: done.cancelled() or done.exception() or done.result().close())
+            raise
+        self.outgoing = asyncio.Queue()
+        self.writer = asyncio.ensure_future(self.writelink(ser, self.outgoing))
+        try:
+            print(f"{ser.name} successfully opened.")
+            self.status = 'connected'
+            self.baudrate = ser.baudrate
+            decoder = None
+            if self.config['protocol'] in ('binary', 'text'):
+                decoder = self.startdecoder(self.config['protocol'], ser)
+            # network sources have no baud rate to negotiate
+            negotiate = decoder is not None and decoder.mode == 'binary' and bool(ser.baudrate)
+            sniffed = b''
+            last_ping = time.monotonic()
+            while True:
+                if self.serial is not None and time.monotonic() - last_ping > 5:
+                    self.sendcommand('ping')
+                    last_ping = time.monotonic()
+                incoming = await self.engine.read(ser)
+                self.countbytes(len(incoming))
+                if not incoming:
+                    continue
+                if decoder is None:
+                    # choose the protocol from the first bytes the sender transmits
+                    sniffed += incoming
+                    mode = detect_protocol(sniffed)
+                    if mode is None:
+                        continue
+                    print(f"Detected {mode} protocol on {self.name}.")
+                    decoder = self.startdecoder(mode, ser)
+                    negotiate = decoder.mode == 'binary' and bool(ser.baudrate)
+                    incoming, sniffed = sniffed, b''
+                self.dispatch(decoder.feed(incoming))
+                if negotiate:
+                    negotiate = False
+                    await self.negotiatebaudrate(ser, decoder)
+        except asyncio.CancelledError:
+            # leaving the live tab or the source: the Pi does not need to stream anymore
+            self.sendcommand('stop')
+            await self.resetbaudrate(ser)
+            await self.drainlink(ser)
+            raise
+        finally:
+            self.serial = None
+            self.writer.cancel()
+            ser.close()
+
+    async def writelink(self, ser, outgoing):
+        """Write the queued commands to the port, in a worker thread so the loop never waits for a port."""
+        while True:
+            command, data = await outgoing.get()
+            try:
+                await self.writecommand(ser, command, data)
+            finally:
+                outgoing.task_done()
+
+    async def writecommand(self, ser, command, data):
+        try:
+            await asyncio.to_thread(ser.write, data)
+        except OSError as e:
+            # a SerialException, also when the write timed out
+            print(f"Error while sending command '{command}' to {self.name}: {e}")
+
+    async def drainlink(self, ser, timeout=1.0):
+        """Wait up to timeout for the queued commands to be written, and then until they went out on the line."""
+        written = asyncio.ensure_future(self.outgoing.join())
+        await asyncio.wait((written, self.writer), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if self.writer.done():
+            # the engine stops and cancelled the writer along with the stream, write what is left here
+            while not self.outgoing.empty():
+                await self.writecommand(ser, *self.outgoing.get_nowait())
+        elif not written.done():
+            print(f"Commands to {self.name} were not written in time.")
+        written.cancel()
+        await asyncio.to_thread(ser.flush)
+
+    def dispatch(self, decoded):
+        """Hand the decoded frames to their handlers."""
+        for frame_type, frames in decoded:
+            if frame_type == FRAME_FILE:
+                if self.linktest is not None:
+                    self.linktest.append(frames)
+                else:
+                    self.viewer.receiverecording(frames, self)
+            elif frame_type == FRAME_RESPONSE:
+                self.receiveresponses(frames)
+            elif frame_type == FRAME_TELEMETRY:
+                self.receivetelemetry(frames)
+            elif frame_type in (FRAME_COP, FRAME_RAW):
+                self.receivesamples(frame_type, frames)
+
+    def countbytes(self, count):
+        """Measure the throughput of the link over periods of one second."""
+        self.linkbytes += count
+        elapsed = time.monotonic() - self.linkstart
+        if elapsed >= 1:
+            self.throughput = self.linkbytes / elapsed
+            self.linkbytes = 0
+            self.linkstart = time.monotonic()
+
+    async def readlink(self, ser, decoder, timeout=1.0):
+        """Read what the port has, or wait up to timeout for it, and dispatch the decoded frames."""
+        incoming = await self.engine.read(ser, timeout)
+        self.countbytes(len(incoming))
+        if incoming:
+            self.dispatch(decoder.feed(incoming))
+
+    async def request(self, ser, decoder, command, argument=None, timeout=1.0):
+        """Send a command and keep reading the link until its response arrives, returns (status, value) or None."""
+        command_id = self.sendcommand(command, argument)
+        if not command_id:
+            return None
+        self.awaiting[command_id] = None
+        deadline = time.monotonic() + timeout
+        while self.awaiting[command_id] is None and time.monotonic() < deadline:
+            await self.readlink(ser, decoder, deadline - time.monotonic())
+        return self.awaiting.pop(command_id)
+
+    async def negotiatebaudrate(self, ser, decoder):
+        """
+        Switch the link to the highest configured baud rate that passes a link test. For every rate above the current
+        one, highest first, the Pi sender and the viewer switch and the Pi sends a test pattern as a bulk transfer.
+        When the pattern arrives intact the rate is confirmed by requesting it again. Otherwise the viewer returns to
+        the previous rate, and the Pi falls back on its own because the confirmation does not come.
+        """
+        for baudrate in sorted(self.config['negotiate'], reverse=True):
+            if baudrate <= ser.baudrate:
+                break
+            previous = ser.baudrate
+            response = await self.request(ser, decoder, 'baud', baudrate)
+            if response is None:
+                print(f"The Pi sender on {self.name} does not negotiate the baud rate.")
+                return
+            if response[0] != STATUS_OK:
+                continue
+            ser.baudrate = baudrate
+            size = max(256, int(baudrate / 10 * LINK_TEST_SECONDS))
+            self.linktest = []
+            start = time.monotonic()
+            if await self.request(ser, decoder, 'test', size) is not None:
+                # the test data follows the response, allow three times its transfer time at this rate
+                deadline = start + 1 + 3 * size * 10 / baudrate
+                while not self.linktest and time.monotonic() < deadline:
+                    await self.readlink(ser, decoder, deadline - time.monotonic())
+            elapsed = time.monotonic() - start
+            passed = self.linktest == [test_pattern(size)]
+            self.linktest = None
+            if passed and await self.request(ser, decoder, 'baud', baudrate) is not None:
+                self.baudrate = baudrate
+                print(f"Link to {self.name} switched to {baudrate} baud, "
+                      f"test throughput {size / elapsed / 1000:.1f} kB/s.")
+                return
+            print(f"Link test of {self.name} at {baudrate} baud failed.")
+            ser.baudrate = previous
+            # wait for the Pi to fall back to the previous rate as well
+            await asyncio.sleep(BAUD_CONFIRM + 0.5)
+            ser.reset_input_buffer()
+
+    async def resetbaudrate(self, ser):
+        """Return the link to the configured baud rate, so the next connection starts at the rate the Pi expects."""
+        baudrate = self.config['baudrate']
+        if not ser.baudrate or ser.baudrate == baudrate or not self.sendcommand('baud', baudrate):
+            return
+        # the Pi switches after its response, then confirm the rate at the new speed
+        await self.drainlink(ser)
+        await asyncio.sleep(0.2)
+        ser.baudrate = self.baudrate = baudrate
+        self.sendcommand('baud', baudrate)
+        await self.drainlink(ser)
+
+    def startdecoder(self, mode, ser):
+        """Return a decoder for the protocol, and open the control channel if the protocol has one."""
+        decoder = get_decoder(mode)
+        self.decoder = decoder
+        # a new stream numbers its samples from scratch, and may come from a sender whose clock was set again
+        self.lastseq = {}
+        self.lostsamples = {}
+        self.offset = None
+        self.offsets.clear()
+        self.arrivals = {}
+        if decoder.mode == 'binary':
+            self.serial = ser
+            self.sendcommand('start')
+            # idle on the live tab at a reduced rate, recordings ask for the full rate
+            self.sendcommand('rate', 0 if self.viewer.recordstate else self.config['idle_rate'])
+        return decoder
+
+    def sendcommand(self, command, argument=None):
+        """
+        Queue a command for the Pi sender, from any thread. Returns its command id, or None if there is no control
+        channel.
+        """
+        outgoing = self.outgoing
+        if self.serial is None or outgoing is None:
+            return None
+        with self.serial_lock:
+            # ids run from 1, so a command id is always true
+            self.command_id = self.command_id % 0xFFFFFFFF + 1
+            command_id = self.command_id
+            self.commands[command_id] = (command, time.monotonic())
+        self.engine.call(outgoing.put_nowait, (command, encode_command(command_id, command, argument)))
+        return command_id
+
+    def receiveresponses(self, frames):
+        """Handle the responses of the Pi sender to our commands."""
+        for response in frames:
+            command_id = int(response['seq'])
+            command, sent = self.commands.pop(command_id, (None, None))
+            if command is None:
+                continue
+            if command_id in self.awaiting:
+                self.awaiting[command_id] = (int(response['status']), float(response['value']))
+            if response['status'] != STATUS_OK:
+                print(f"The Pi sender on {self.name} could not execute '{command}'.")
+            elif command == 'ping':
+                self.latency = time.monotonic() - sent
+
+    def receivetelemetry(self, frames):
+        """Keep the telemetry of the Pi sender, for the diagnostics panel and to save it with recordings."""
+        for frame in frames:
+            entry = {"time": float(frame['time'])}
+            entry.update((field, frame[field].item()) for field, _ in PAYLOAD_FIELDS[FRAME_TELEMETRY])
+            self.telemetry.append(entry)
+        del self.telemetry[:-TELEMETRY_HISTORY]
+
+    def telemetrybetween(self, start, end):
+        """Telemetry between two timestamps of the sender's clock, with the time relative to the start."""
+        return [dict(entry, time=entry['time'] - start) for entry in list(self.telemetry)
+                if start <= entry['time'] <= end]
+
+    def receivesamples(self, frame_type, frames):
+        """Hand a batch of decoded frames to the viewer, per board and on the host clock."""
+        boards = np.unique(frames['board']).tolist()
+        if len(boards) == 1:
+            self.receiveboard(boards[0], frame_type, frames)
+        else:
+            for board in boards:
+                self.receiveboard(board, frame_type, frames[frames['board'] == board])
+        self.status = 'display'
+
+    def receiveboard(self, board, frame_type, frames):
+        """Hand the frames of one board to the viewer."""
+        if frame_type == FRAME_RAW:
+            # compute the center of pressure for the whole batch with the configured board geometry
+            raw = raw_values(frames)
+            x, y, weight = cop_from_raw(raw, self.config['width'], self.config['length'])
+            self.weight[board] = weight[-1]
+        else:
+            x, y = frames['x'], frames['y']
+            raw = np.full((len(frames), len(RAW_FIELDS)), np.nan)
+        now = time.time()
+        times = frames['time']
+        if np.isnan(times).any():
+            # sender without board timestamps, fall back to the host clock: the samples are spread evenly over the time
+            # since the previous batch arrived, or at the highest rate after a pause, so no two get the same time
+            previous = self.arrivals.get(board)
+            if previous is None or now - previous > SPREAD_MAX:
+                previous = now - len(frames) / self.config['max_rate']
+            self.arrivals[board] = now
+            times = np.where(np.isnan(times), previous + (now - previous) * np.arange(1, len(frames) + 1) / len(frames),
+                             times)
+        if self.offset is None or not self.viewer.recordstate:
+            arrived, offset = time.monotonic(), now - times[-1]
+            # a sliding minimum: an offset that is not smaller than a later one can never be the smallest again
+            while self.offsets and self.offsets[-1][1] >= offset:
+                self.offsets.pop()
+            self.offsets.append((arrived, offset))
+            while arrived - self.offsets[0][0] > OFFSET_WINDOW:
+                self.offsets.popleft()
+            self.offset = self.offsets[0][1]
+        # samples the sender numbered but that never arrived, lost on the Pi or on the link
+        seq = frames['seq'].astype(np.int64)
+        missing = int(seq_gaps(seq, self.lastseq.get(board)).sum())
+        self.lastseq[board] = int(seq[-1])
+        if missing:
+            self.lostsamples[board] = self.lostsamples.get(board, 0) + missing
+        self.viewer.receiveboard(self, board, np.vstack((times + self.offset, x, y, raw.T, seq)))
+
+    def tooltip(self):
+        """Weight on the boards, only known when the sender streams raw sensor values, and the state of the link."""
+        tooltip = []
+        weights = sorted(self.weight.items())
+        if len(weights) == 1:
+            tooltip.append(f"Weight on board: {weights[0][1]:.1f} kg")
+        else:
+            tooltip.extend(f"Weight on board {board + 1}: {weight:.1f} kg" for board, weight in weights)
+        lost = sum(self.lostsamples.values())
+        if lost:
+            tooltip.append(f"Lost samples: {lost}")
+        # lines of the text protocol that could not be parsed, corrupt frames of the binary protocol
+        errors = getattr(self.decoder, 'parse_errors', 0) + getattr(self.decoder, 'crc_errors', 0)
+        if errors:
+            tooltip.append(f"Corrupt data: {errors}")
+        # bytes of the binary protocol that were not part of a frame, transfers that failed their integrity check
+        skipped = getattr(self.decoder, 'skipped_bytes', 0)
+        if skipped:
+            tooltip.append(f"Skipped bytes: {skipped}")
+        failed = getattr(self.decoder, 'file_errors', 0)
+        if failed:
+            tooltip.append(f"Failed transfers: {failed}")
+        if self.latency is not None:
+            tooltip.append(f"Round trip time: {1000 * self.latency:.1f} ms")
+        if self.throughput is not None and self.status != 'disconnected' and self.baudrate:
+            # a byte on the line takes 10 bits with the start and stop bit
+            load = 100 * self.throughput * 10 / self.baudrate
+            tooltip.append(f"Link: {self.baudrate} baud, {self.throughput / 1000:.1f} kB/s, "
+                           f"{load:.0f}% of the line")
+        elif self.throughput is not None and self.status != 'disconnected':
+            tooltip.append(f"Link: {self.name}, {self.throughput / 1000:.1f} kB/s")
+        return '\n'.join(tooltip)
@@ -0,0 +1,131 @@
+"""
+Sources the viewer reads the Pi sender from: a serial port, or a Pi sender on the network.
+
+Network sources are written as tcp://host:port or udp://host:port. They behave like a serial port without a baud
+rate, so the ingest loop, the commands and the decoders work the same on every transport. Errors of a network source
+are raised as serial.SerialException, so a lost connection is handled like an unplugged port.
+"""
+import time
+import socket
+import select
+import serial
+
+# port the Pi sender listens on, see --port of step_pi_sender.py
+DEFAULT_PORT = 8765
+# seconds between the datagrams a UDP source sends to tell the Pi where to stream to and that it is still there
+UDP_HELLO_INTERVAL = 1.0
+# bytes read from the socket in one go at most, so a fast stream cannot keep a read busy
+MAX_BUFFER = 1 << 20
+
+
+def is_network_source(source: str) -> bool:
+    return source.startswith(('tcp://', 'udp://'))
+
+
+def parse_source(source: str):
+    """Split a network source into its scheme, host and port."""
+    scheme, _, address = source.partition('://')
+    host, _, port = address.rpartition(':')
+    if not host:
+        host, port = address, DEFAULT_PORT
+    return scheme, host.strip('[]'), int(port)
+
+
+class NetworkPort:
+    """
+    A TCP connection or a UDP socket to the Pi sender with the part of the pyserial interface the viewer uses.
+    Over UDP the Pi streams to the address the last datagram came from, so the port says hello when it opens and
+    repeats it every UDP_HELLO_INTERVAL while it reads, a Pi that stops hearing from it stops streaming.
+    """
+    baudrate = None
+
+    def __init__(self, source: str, timeout: float = 1.0):
+        self.name = source
+        self.timeout = timeout
+        self.scheme, host, port = parse_source(source)
+        self._buffer = bytearray()
+        self._hello = 0.0
+        try:
+            if self.scheme == 'tcp':
+                self.sock = socket.create_connection((host, port), timeout=timeout)
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            elif self.scheme == 'udp':
+                self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self.sock.connect((host, port))
+            else:
+                raise serial.SerialException(f"Unknown transport: {self.scheme}")
+            # reads only happen when select says there is data, the timeout limits how long a write can stall
+            self.sock.settimeout(timeout)
+        except OSError as e:
+            raise serial.SerialException(f"Could not connect to {source}: {e}") from e
+        self.is_open = True
+        self._sayhello()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _sayhello(self):
+        if self.scheme == 'udp' and time.monotonic() - self._hello > UDP_HELLO_INTERVAL:
+            # an empty line, the Pi ignores it as a command
+            self.write(b'\n')
+            self._hello = time.monotonic()
+
+    def _receive(self, timeout: float):
+        """Move what the socket has into the buffer, waiting up to timeout for the first bytes."""
+        try:
+            while select.select([self.sock], [], [], timeout)[0]:
+                data = self.sock.recv(65536)
+                if not data and self.scheme == 'tcp':
+                    raise serial.SerialException(f"{self.name} closed the connection.")
+                self._buffer += data
+                timeout = 0
+                if len(self._buffer) >= MAX_BUFFER:
+                    break
+            self._sayhello()
+        except serial.SerialException:
+            raise
+        except OSError as e:
+            raise serial.SerialException(f"Connection to {self.name} lost: {e}") from e
+
+    @property
+    def in_waiting(self) -> int:
+        self._receive(0)
+        return len(self._buffer)
+
+    def read(self, size: int = 1) -> bytes:
+        """Return up to size bytes, waiting up to the timeout when nothing is buffered."""
+        if not self._buffer:
+            self._receive(self.timeout)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def write(self, data: bytes) -> int:
+        try:
+            self.sock.sendall(data)
+        except OSError as e:
+            raise serial.SerialException(f"Connection to {self.name} lost: {e}") from e
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._receive(0)
+        self._buffer.clear()
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self.sock.close()
+
+
+def open_source(source: str, baudrate: int, timeout: float = 1.0):
+    """Open a serial port, or a network source written as tcp://host:port or udp://host:port."""
+    if is_network_source(source):
+        return NetworkPort(source, timeout)
+    # a port that does not take its data holds up the writer of its own source for the timeout at most
+    return serial.Serial(source, baudrate, timeout=timeout, write_timeout=timeout)
@@ -1,8 +1,27 @@
-from PySide6.QtWidgets import QWidget, QVBoxLayout
+from PySide6.QtWidgets import QWidget, QVBoxLayout, QGroupBox, QFormLayout, QLabel
 import pyqtgraph as pg
 
+# line colors of the boards, the first board is drawn in the blue of the main line
+BOARD_COLORS = [(0, 0, 255), (255, 0, 0), (0, 160, 0), (255, 140, 0)]
 
-class Stabilogram(QWidget):
+
+class BoardLines:
+    """Mixin for plots that show one line per balance board."""
+
+    def boardline(self, board):
+        """Return the line of a board, the line of the first board is the main line."""
+        if board == 0:
+            return self.line
+        if not hasattr(self, 'boardlines'):
+            self.boardlines = {}
+        if board not in self.boardlines:
+            color = BOARD_COLORS[board % len(BOARD_COLORS)]
+            self.boardlines[board] = pg.PlotCurveItem(pen=pg.mkPen(color=color, width=3))
+            self.graph.addItem(self.boardlines[board])
+        return self.boardlines[board]
+
+
+class Stabilogram(QWidget, BoardLines):
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -26,7 +45,7 @@ class Stabilogram(QWidget):
         self.graph.hideButtons()
 
 
-class ApMl(QWidget):
+class ApMl(QWidget, BoardLines):
     """Widget for displaying APML data."""
 
     def __init__(self, parent=None):
@@ -61,6 +80,39 @@ class ApMl(QWidget):
             self.graph.setTitle('ML')
 
 
+class Diagnostics(QGroupBox):
+    """Panel with the latest telemetry of the Pi sender."""
+
+    # telemetry field: label and format of the value
+    FIELDS = {
+        "cpu": ("CPU load", "{:.1f} %"),
+        "temperature": ("Temperature", "{:.1f} \u00b0C"),
+        "syn_dropped": ("Kernel overruns", "{:d}"),
+        "lost": ("Lost reports", "{:d}"),
+        "incomplete": ("Incomplete reports", "{:d}"),
+        "buffered": ("Buffered samples", "{:d}"),
+        "discarded": ("Discarded samples", "{:d}"),
+        "bytes_written": ("Bytes sent", "{:,d}"),
+        "boards": ("Boards", "{:d}"),
+    }
+
+    def __init__(self, parent=None):
+        super().__init__("Pi diagnostics", parent)
+        self.layout = QFormLayout(self)
+        self.values = {}
+        for field, (label, _) in self.FIELDS.items():
+            self.values[field] = QLabel("--")
+            self.layout.addRow(label, self.values[field])
+
+    def setvalues(self, telemetry):
+        """Show a telemetry dict, None clears the panel."""
+        for field, (_, fmt) in self.FIELDS.items():
+            value = None if telemetry is None else telemetry.get(field)
+            text = "--" if value is None or value != value else fmt.format(value)
+            if self.values[field].text() != text:
+                self.values[field].setText(text)
+
+
 class Entropy(QWidget):
     """
     Widget for displaying entropy data.